@@ -116,8 +116,15 @@ class Ui_Form(object):
 
         self.horizontalLayout.addWidget(self.page_number)
 
+        self.label_progress = QLabel(Form)
+        self.label_progress.setObjectName(u"label_progress")
+        self.label_progress.setAlignment(Qt.AlignmentFlag.AlignCenter)
+
+        self.horizontalLayout.addWidget(self.label_progress)
+
         self.horizontalLayout.setStretch(0, 1)
         self.horizontalLayout.setStretch(1, 8)
+        self.horizontalLayout.setStretch(2, 2)
 
         self.Display.addLayout(self.horizontalLayout)
 
@@ -316,8 +323,15 @@ class Ui_Form(object):
 
         self.horizontalLayout_11.addWidget(self.pushButton_export)
 
+        self.pushButton_cancel = QPushButton(Form)
+        self.pushButton_cancel.setObjectName(u"pushButton_cancel")
+        self.pushButton_cancel.setEnabled(False)
+
+        self.horizontalLayout_11.addWidget(self.pushButton_cancel)
+
         self.horizontalLayout_11.setStretch(0, 1)
-        self.horizontalLayout_11.setStretch(1, 5)
+        self.horizontalLayout_11.setStretch(1, 4)
+        self.horizontalLayout_11.setStretch(2, 1)
 
         self.Info.addLayout(self.horizontalLayout_11)
 
@@ -339,6 +353,7 @@ class Ui_Form(object):
         self.label_perturb_y_sigma.setText(QCoreApplication.translate("Form", u"\u7eb5\u5411\u7b14\u753b\u6270\u52a8", None))
         self.label_perturb_theta_sigma.setText(QCoreApplication.translate("Form", u"\u65cb\u8f6c\u7b14\u753b\u6270\u52a8", None))
         self.page_label.setText(QCoreApplication.translate("Form", u"Page:", None))
+        self.label_progress.setText("")
         self.groupBox.setTitle(QCoreApplication.translate("Form", u"\u914d\u7f6e", None))
         self.label_current_config.setText(QCoreApplication.translate("Form", u"current configure:", None))
         self.pushButton_load_config.setText(QCoreApplication.translate("Form", u"\u52a0\u8f7d\u914d\u7f6e", None))
@@ -353,5 +368,6 @@ class Ui_Form(object):
         self.label_char_color.setText(QCoreApplication.translate("Form", u"\u5b57\u4f53\u8272", None))
         self.label_background_color.setText(QCoreApplication.translate("Form", u"\u80cc\u666f\u8272", None))
         self.pushButton_export.setText(QCoreApplication.translate("Form", u"Export", None))
+        self.pushButton_cancel.setText(QCoreApplication.translate("Form", u"Cancel", None))
     # retranslateUi
 
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Render performance benchmark.
+
+Runs handwrite_generator over every combination of rate (BasicTools.default_rate_dict), font
+(ttf_library/) and document size (short, medium, book), each case in a fresh process so that
+its peak RSS is measured in isolation. For every case it records the time spent in layout,
+rendering and encoding, the resulting pages/s and the peak RSS, and writes everything as JSON.
+Passing a previous result file with --baseline reports cases that became slower.
+
+It also measures GUI cold starts: main.py is launched in a fresh interpreter (offscreen) several
+times, recording when the window is first shown, when the backend is ready and when the default
+preview is displayed. A median time to window above --startup-target fails the run.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --rates x1 x4 --sizes short medium --baseline bench.json
+    python benchmark.py --startup-only --startup-runs 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import PIL
+
+from core import handwrite_generator
+from fonts import default_registry
+from layout import preprocess_text
+from profiling import peak_rss_mb
+from tools import BasicTools
+from writers import PageFormat
+
+_PARAGRAPH = ("吾读史至商鞅徙木立信一事，而叹吾国国民之愚也，而叹执政者之煞费苦心也，"
+              "而叹数千年来民智之不开、国几蹈于沦亡之惨也。谓予不信，请罄其说。\n"
+              "法令者，代谋幸福之具也。法令而善，其幸福吾民也必多，吾民方恐其不布此法令，"
+              "或布而恐其不生效力，必竭全力以保障之，维持之，务使达到完善之目的而止。\n")
+
+# 文档规模 -> 字符数
+TEXT_SIZES = {
+    "short": 200,
+    "medium": 3000,
+    "book": 100000,
+}
+
+
+def sample_text(size):
+    chars = TEXT_SIZES[size]
+    return (_PARAGRAPH * (chars // len(_PARAGRAPH) + 1))[:chars]
+
+
+def run_case(case):
+    """
+    Benchmarks one (rate, font, size, engine) case in the current process.
+
+    Layout is timed over the whole text; rendering and encoding over at most max_pages pages.
+    Rates of 32 and above are rendered tiled like the GUI does, where rendering and encoding
+    cannot be separated and are reported together as render_s.
+    """
+    generator = handwrite_generator()
+    generator.modify_template_params(rate=case["rate"], default_font=case["font"],
+                                     default_font_index=case["font_index"])
+    text = sample_text(case["size"])
+
+    start = time.perf_counter()
+    spans = generator.paginate(text)
+    layout_s = time.perf_counter() - start
+
+    if case["max_pages"] and len(spans) > case["max_pages"]:
+        text = preprocess_text(text)[:spans[case["max_pages"] - 1][1]]
+    tiled = case["rate"] >= 32
+    page_format = PageFormat()
+    render_s = encode_s = 0.0
+    pages = 0
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_dir = Path(output_dir)
+        start = time.perf_counter()
+        if tiled:
+            for _ in generator.iter_images(text, output_dir=output_dir, tiled=True):
+                pages += 1
+            render_s = time.perf_counter() - start
+        else:
+            for num, im in generator.iter_images(text, save=False, engine=case["engine"]):
+                render_s += time.perf_counter() - start
+                start = time.perf_counter()
+                page_format.save(im, page_format.page_path(output_dir, num))
+                del im
+                encode_s += time.perf_counter() - start
+                pages += 1
+                start = time.perf_counter()
+
+    total_s = render_s + encode_s
+    peak_rss = peak_rss_mb()
+    return dict(case,
+                chars=len(sample_text(case["size"])),
+                pages=len(spans),
+                rendered_pages=pages,
+                layout_s=round(layout_s, 4),
+                render_s=round(render_s, 4),
+                encode_s=round(encode_s, 4),
+                pages_per_s=round(pages / total_s, 4) if total_s else None,
+                peak_rss_mb=None if peak_rss is None else round(peak_rss, 1))
+
+
+def measure_startup(runs, timeout=60):
+    """
+    Launches main.py --startup-probe runs times and takes the median of each startup milestone.
+
+    Returns:
+        {"runs", "window_s", "backend_s", "preview_s"} in seconds since launch, or {"runs", "error"}
+        if the GUI could not be started (e.g. PySide6 is not installed).
+    """
+    main_py = Path(__file__).with_name("main.py")
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    samples = {"shown": [], "backend": [], "preview": []}
+    for _ in range(runs):
+        launched = time.time()
+        try:
+            proc = subprocess.run([sys.executable, str(main_py), "--startup-probe"], cwd=main_py.parent, env=env,
+                                  capture_output=True, text=True, timeout=timeout)
+            marks = json.loads(proc.stdout.strip().splitlines()[-1])
+        except (OSError, subprocess.TimeoutExpired, ValueError, IndexError):
+            return {"runs": runs, "error": "main.py --startup-probe failed"}
+        if "error" in marks:
+            return {"runs": runs, "error": "backend failed to load"}
+        for name in samples:
+            samples[name].append(marks[name] - launched)
+    return {"runs": runs,
+            "window_s": round(statistics.median(samples["shown"]), 4),
+            "backend_s": round(statistics.median(samples["backend"]), 4),
+            "preview_s": round(statistics.median(samples["preview"]), 4)}
+
+
+def case_key(result):
+    return result["rate"], Path(result["font"]).name, result.get("font_index", 0), result["size"], result["engine"]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares pages/s against a baseline result file.
+
+    Returns:
+        The list of (result, baseline_result, ratio) for cases slower than baseline by more than tolerance.
+    """
+    previous = {case_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None or not old["pages_per_s"] or not result["pages_per_s"]:
+            continue
+        ratio = result["pages_per_s"] / old["pages_per_s"]
+        if ratio < 1 - tolerance:
+            regressions.append((result, old, ratio))
+    return regressions
+
+
+def main(argv=None):
+    rates = BasicTools().default_rate_dict
+    parser = argparse.ArgumentParser(description="Benchmark rendering across rates, fonts and document sizes.")
+    parser.add_argument("--rates", nargs="+", choices=list(rates), default=list(rates),
+                        help="rates to run (default: all)")
+    parser.add_argument("--fonts", nargs="+", default=None,
+                        help="font files to run (default: every font in ttf_library/)")
+    parser.add_argument("--sizes", nargs="+", choices=list(TEXT_SIZES), default=list(TEXT_SIZES),
+                        help="document sizes to run (default: all)")
+    parser.add_argument("--engine", choices=("handright", "glyph", "numpy"), default="handright")
+    parser.add_argument("--max-pages", type=int, default=5,
+                        help="pages rendered per case, 0 for all; layout always covers the whole text (default: 5)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="result file (default: benchmark.json)")
+    parser.add_argument("--baseline", help="previous result file to compare pages/s against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown reported as a regression (default: 0.1)")
+    parser.add_argument("--startup-runs", type=int, default=3,
+                        help="GUI cold starts to measure, 0 to skip (default: 3)")
+    parser.add_argument("--startup-target", type=float, default=1.0,
+                        help="median seconds from launch to window shown above which the run fails (default: 1.0)")
+    parser.add_argument("--startup-only", action="store_true", help="only measure GUI cold starts")
+    args = parser.parse_args(argv)
+
+    fonts = [(path, 0) for path in args.fonts] if args.fonts else [(f.path, f.index) for f in default_registry()]
+    cases = [{"rate": rates[rate], "font": font, "font_index": index, "size": size, "engine": args.engine,
+              "max_pages": args.max_pages}
+             for rate in args.rates for font, index in fonts for size in args.sizes]
+    if args.startup_only:
+        cases = []
+    results = []
+    # 每个用例在新进程中运行, 峰值内存互不影响
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for i, result in enumerate(pool.imap(run_case, cases), 1):
+            results.append(result)
+            print(f"[{i}/{len(cases)}] x{result['rate']} {Path(result['font']).stem} {result['size']}: "
+                  f"{result['pages_per_s']} pages/s, layout {result['layout_s']}s, render {result['render_s']}s, "
+                  f"encode {result['encode_s']}s, peak {result['peak_rss_mb']} MB")
+
+    startup = None
+    if args.startup_runs:
+        startup = measure_startup(args.startup_runs)
+        if "error" in startup:
+            print(f"Startup: {startup['error']}")
+        else:
+            print(f"Startup (median of {startup['runs']}): window {startup['window_s']}s, "
+                  f"backend {startup['backend_s']}s, preview {startup['preview_s']}s "
+                  f"(target {args.startup_target}s)")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+        "startup": startup,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    status = 0
+    if startup and startup.get("window_s", 0) > args.startup_target:
+        print(f"[regression] startup: window shown after {startup['window_s']}s, target {args.startup_target}s")
+        status = 1
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, old, ratio in regressions:
+            print(f"[regression] x{result['rate']} {Path(result['font']).stem} {result['size']}: "
+                  f"{old['pages_per_s']} -> {result['pages_per_s']} pages/s ({ratio:.0%})")
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
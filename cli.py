@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch renderer.
+
+Renders many documents with the settings of a config.Config TOML file, one output folder per
+document, spreading the documents across a process pool. With --queue, the documents are split
+into per-page tasks in a SQLite job queue (see job_queue.py) so that a crashed or interrupted run
+resumes where it stopped when started again with the same queue file. Never imports PySide6.
+
+Usage:
+    python cli.py --config homework.toml --output outputs/batch texts/
+    python cli.py --config homework.toml "texts/**/*.txt" more.jsonl
+    python cli.py --config homework.toml --queue overnight.db texts/
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from config import Config
+from core import handwrite_generator
+from job_queue import LAYOUT_TASK, JobQueue, worker_id
+from render_cache import DEFAULT_CACHE_DIR, RenderCache
+from writers import PageFormat
+
+# 每个工作进程持有一个已加载配置的生成器, 字体和模板在同一进程的文档之间复用
+_worker_generator = None
+_worker_options = {}
+_LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+
+
+def _init_batch_worker(config_path, options, cache=None, log_level=None):
+    global _worker_generator, _worker_options
+    if log_level is not None:
+        # spawn 方式启动的工作进程不继承主进程的日志配置
+        logging.basicConfig(level=log_level, format=_LOG_FORMAT)
+    _worker_options = options
+    _worker_generator = handwrite_generator()
+    _worker_generator.render_cache = cache
+    if config_path:
+        _worker_generator.apply_config(Config(config_path))
+
+
+def _render_document(job):
+    name, text, output_dir = job
+    start = time.perf_counter()
+    stages = {}
+    try:
+        options = dict(_worker_options)
+        profile_dir = options.pop("profile_dir")
+        profile = None if profile_dir is None else Path(profile_dir, f"{name}.prof")
+        rates = options.pop("rates")
+        if options.pop("pdf"):
+            pages = _worker_generator.generate_pdf(text, output_dir.with_suffix(".pdf"), engine=options["engine"],
+                                                   compress_level=options["compress_level"], profile=profile)
+            stages = {stage: s["seconds"] for stage, s in pages.stats["stages"].items()}
+        elif rates:
+            levels = _worker_generator.generate_pyramid(text, rates, output_dir=output_dir, engine=options["engine"],
+                                                        image_format=options["image_format"],
+                                                        compress_level=options["compress_level"], profile=profile)
+            pages = levels[max(rates)]
+            stages = {stage: s["seconds"] for stage, s in levels.stats["stages"].items()}
+        else:
+            pages = _worker_generator.generate_image(text, output_dir=output_dir, profile=profile, **options)
+            stages = {stage: s["seconds"] for stage, s in pages.stats["stages"].items()}
+    except Exception as e:
+        return name, 0, time.perf_counter() - start, f"{type(e).__name__}: {e}", stages
+    return name, len(pages), time.perf_counter() - start, None, stages
+
+
+def _drain_queue(queue, lease_pages):
+    # 反复领取同一文档的若干页任务并渲染, 直到队列中没有可运行或仍被领取的任务
+    owner = worker_id()
+    rendered = 0
+    while True:
+        lease = queue.lease(owner, lease_pages)
+        if lease is None:
+            if not queue.has_leased():
+                return rendered
+            time.sleep(0.5)  # 其他进程的排版任务完成后会添加页面任务
+            continue
+        doc_id, name, text, output_dir, pages = lease
+        output_dir = Path(output_dir)
+        try:
+            if pages[0] == LAYOUT_TASK:
+                page_count = len(_worker_generator.paginate(text))
+                # 文档内容变化后页数可能减少, 删除多余的旧页面
+                page_format = PageFormat(_worker_options["image_format"])
+                for path in output_dir.glob(f"*{page_format.suffix}"):
+                    if path.stem.isdigit() and int(path.stem) >= page_count:
+                        path.unlink()
+                queue.complete(doc_id, LAYOUT_TASK, owner, page_count)
+                continue
+            remaining = list(pages)
+            for num, _ in _worker_generator.iter_images(text, output_dir=output_dir, page_numbers=pages,
+                                                         **_worker_options):
+                queue.complete(doc_id, num, owner)
+                remaining.remove(num)
+                rendered += 1
+                queue.renew(doc_id, remaining, owner)
+        except Exception as e:
+            logging.getLogger("handwrite.queue").warning("%s pages %s failed: %s", name, pages, e)
+            for num in pages if pages[0] == LAYOUT_TASK else remaining:
+                queue.fail(doc_id, num, owner, f"{type(e).__name__}: {e}")
+
+
+def iter_documents(inputs):
+    """
+    Expands the command line inputs into (name, text) pairs.
+
+    Args:
+        inputs: Directories (every *.txt inside, recursively), JSONL files (one {"text": ..., "name": ...}
+            object per line), plain text files or glob patterns matching any of these.
+
+    Yields:
+        (name, text) for every document, in input order.
+    """
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            paths = sorted(path.rglob("*.txt"))
+        elif path.exists():
+            paths = [path]
+        else:
+            paths = [Path(p) for p in sorted(glob.glob(item, recursive=True))]
+            if not paths:
+                print(f"Warning: {item} matched no files.", file=sys.stderr)
+        for p in paths:
+            if p.suffix == ".jsonl":
+                with open(p, encoding="utf-8") as f:
+                    for line_number, line in enumerate(f, 1):
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        name = record.get("name") or record.get("id") or f"{p.stem}-{line_number}"
+                        yield str(name), record["text"]
+            elif p.is_file():
+                yield p.stem, p.read_text(encoding="utf-8")
+
+
+def _collect_jobs(inputs, output_root):
+    output_root = Path(output_root)
+    jobs = []
+    seen = {}
+    for name, text in iter_documents(inputs):
+        # 同名文档追加序号, 避免输出目录互相覆盖
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        folder = name if count == 0 else f"{name}-{count}"
+        jobs.append((folder, text, output_root.joinpath(folder)))
+    return jobs
+
+
+def run_batch(config_path, inputs, output_root, workers=None, tiled=False, engine="handright", incremental=False,
+              cache=None, image_format="png", compress_level=6, pdf=False, profile_dir=None, rates=None):
+    """
+    Renders every document found in inputs into output_root/<name>/ (or output_root/<name>.pdf
+    with pdf=True) and prints a summary including the time spent per render stage. With profile_dir,
+    every document is rendered under cProfile and its statistics saved as profile_dir/<name>.prof.
+    With rates, every document is rendered once at the highest rate and saved at each of them into
+    output_root/<name>/x<rate>/ (see handwrite_generator.generate_pyramid).
+    tiled, engine, incremental, image_format and compress_level are passed on to
+    handwrite_generator.generate_image; documents found in cache (a render_cache.RenderCache)
+    are copied instead of rendered.
+
+    Returns:
+        The list of (name, error) pairs for the documents that failed.
+    """
+    jobs = _collect_jobs(inputs, output_root)
+    failures = []
+    total_pages = 0
+    start = time.perf_counter()
+    options = {"tiled": tiled, "engine": engine, "incremental": incremental,
+               "image_format": image_format, "compress_level": compress_level, "pdf": pdf,
+               "profile_dir": profile_dir, "rates": rates}
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    stage_totals = {}
+    initargs = (config_path, options, cache, logging.getLogger().level)
+    with multiprocessing.Pool(workers, initializer=_init_batch_worker, initargs=initargs) as pool:
+        for name, pages, seconds, error, stages in pool.imap_unordered(_render_document, jobs):
+            for stage, stage_seconds in stages.items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + stage_seconds
+            if error is None:
+                total_pages += pages
+                print(f"[ok] {name}: {pages} pages in {seconds:.1f}s")
+            else:
+                failures.append((name, error))
+                print(f"[failed] {name}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    print(f"\nDocuments: {len(jobs) - len(failures)} succeeded, {len(failures)} failed")
+    print(f"Pages: {total_pages} in {elapsed:.1f}s ({total_pages / elapsed if elapsed else 0:.2f} pages/s)")
+    if stage_totals:
+        print("Stages: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_totals.items()))
+    for name, error in failures:
+        print(f"  {name}: {error}")
+    return failures
+
+
+def run_queue(config_path, inputs, output_root, queue_path, workers=None, tiled=False, engine="handright",
+              image_format="png", compress_level=6, retries=2, lease_pages=4):
+    """
+    Renders every document found in inputs into output_root/<name>/ through the persistent job
+    queue at queue_path. Documents already queued with the same text and settings keep their
+    completed pages, tasks leased by processes that died are handed out again, and failed tasks
+    are retried up to retries times. Each worker leases up to lease_pages pages of one document.
+    When a worker process dies mid-run (e.g. killed by the OOM killer), the pages leased by the
+    workers are returned to the queue at once and the run continues with fresh workers.
+
+    Returns:
+        The list of (name, error) pairs for the pages that failed for good.
+    """
+    options = {"tiled": tiled, "engine": engine, "image_format": image_format, "compress_level": compress_level}
+    settings = (Config(config_path).get_raw_config() if config_path else {}, sorted(options.items()))
+    queue = JobQueue(queue_path, max_attempts=retries + 1)
+    added = sum(queue.enqueue(folder, text, output_dir, settings)
+                for folder, text, output_dir in _collect_jobs(inputs, output_root))
+    queue.reclaim()
+    counts = queue.counts()
+    print(f"Queue {queue_path}: {added} new or changed document(s), {counts['done']} page(s) already done")
+
+    start = time.perf_counter()
+    done_before = counts["done"]
+    workers = workers or os.cpu_count()
+    initargs = (config_path, options, None, logging.getLogger().level)
+    stalled = 0
+    while True:
+        # 工作进程被杀死 (例如 OOM) 时进程池整体失效: 回收死亡进程领取的页面, 再以新的进程池继续
+        progress = queue.counts()
+        with ProcessPoolExecutor(workers, initializer=_init_batch_worker, initargs=initargs) as executor:
+            try:
+                pending = {executor.submit(_drain_queue, queue, lease_pages) for _ in range(workers)}
+                while pending:
+                    finished, pending = wait(pending, timeout=10)
+                    for future in finished:
+                        future.result()
+                    counts = queue.counts()
+                    print(f"[progress] {counts['done']} done, {counts['leased']} rendering, "
+                          f"{counts['pending']} pending, {counts['failed']} failed")
+                break
+            except BrokenProcessPool:
+                # 反复崩溃的页面在用完重试次数后标记为失败; 没有任何进展的反复崩溃 (如初始化失败) 不再重启
+                stalled = stalled + 1 if queue.counts() == progress else 0
+                if stalled > queue.max_attempts:
+                    raise
+                print("[restart] a worker process died; its pages are returned to the queue", file=sys.stderr)
+        queue.reclaim()
+    rendered = queue.counts()["done"] - done_before
+    elapsed = time.perf_counter() - start
+
+    failures = [(name, f"page {page}: {error}" if page != LAYOUT_TASK else f"layout: {error}")
+                for name, page, error in queue.failures()]
+    counts = queue.counts()
+    queue.close()
+    print(f"\nPages: {rendered} rendered in {elapsed:.1f}s ({rendered / elapsed if elapsed else 0:.2f} pages/s), "
+          f"{counts['done']} done in total, {counts['failed']} failed")
+    for name, error in failures:
+        print(f"  {name}: {error}")
+    return failures
+
+
+def _parse_rates(value):
+    try:
+        rates = sorted({int(rate) for rate in value.split(",") if rate.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rates: {value}")
+    if not rates or rates[0] < 1:
+        raise argparse.ArgumentTypeError(f"invalid rates: {value}")
+    return rates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render handwriting for many documents without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="text files, directories, JSONL files or glob patterns")
+    parser.add_argument("-c", "--config", help="TOML configuration saved from the GUI")
+    parser.add_argument("-o", "--output", default=os.path.join("outputs", "batch"),
+                        help="root folder, one sub-folder per document (default: outputs/batch)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: all CPU cores)")
+    parser.add_argument("--tiled", action="store_true",
+                        help="render pages band by band to bound memory (recommended for x32/x64)")
+    parser.add_argument("--engine", choices=("handright", "glyph", "numpy"), default="handright",
+                        help="render engine; glyph caches rasterized strokes and is much faster on long texts, "
+                             "numpy perturbs strokes with NumPy and matches handright pixel for pixel")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-render pages whose text, layout or settings changed since the last run")
+    parser.add_argument("--format", choices=("png", "tiff", "webp"), default="png",
+                        help="page file format; tiff is uncompressed and fastest to write, webp is lossless")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=6, metavar="0-9",
+                        help="PNG compression level, lower is faster (default: 6)")
+    parser.add_argument("--pdf", action="store_true",
+                        help="write one multi-page PDF per document, sized for printing, instead of page images")
+    parser.add_argument("--rates", type=_parse_rates, metavar="R1,R2,...",
+                        help="render once at the highest rate and also save downsampled copies at the other rates, "
+                             "e.g. 2,8 (written to <name>/x2/ and <name>/x8/)")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="render every document under cProfile and save DIR/<name>.prof")
+    parser.add_argument("--log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="INFO logs per-document stage timings as JSON, DEBUG also per page (default: WARNING)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help=f"content-addressed render cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-size", type=int, default=2048, help="render cache size limit in MiB (default: 2048)")
+    parser.add_argument("--no-cache", action="store_true", help="always render, bypassing the render cache")
+    parser.add_argument("--queue", metavar="DB",
+                        help="persistent SQLite job queue of per-page tasks; rerunning with the same file resumes")
+    parser.add_argument("--retries", type=int, default=2, help="retries per page with --queue (default: 2)")
+    parser.add_argument("--lease-pages", type=int, default=4,
+                        help="pages of one document a worker takes at a time with --queue (default: 4)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format=_LOG_FORMAT)
+    if args.pdf and (args.tiled or args.incremental):
+        parser.error("--pdf cannot be combined with --tiled or --incremental")
+    if args.rates and (args.pdf or args.tiled or args.incremental):
+        parser.error("--rates cannot be combined with --pdf, --tiled or --incremental")
+    if args.queue:
+        if args.pdf or args.incremental or args.profile or args.rates:
+            parser.error("--queue cannot be combined with --pdf, --incremental, --profile or --rates")
+        failures = run_queue(args.config, args.inputs, args.output, args.queue, args.workers, args.tiled,
+                             args.engine, args.format, args.compress_level, args.retries, args.lease_pages)
+        return 1 if failures else 0
+    cache = None if args.no_cache else RenderCache(args.cache_dir, args.cache_size << 20)
+    failures = run_batch(args.config, args.inputs, args.output, args.workers, args.tiled, args.engine,
+                         args.incremental, cache, args.format, args.compress_level, args.pdf, args.profile,
+                         args.rates)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
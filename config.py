@@ -27,6 +27,18 @@ class Config:
             except tomllib.TOMLDecodeError as e:
                 print(f"Error decoding TOML file {path}: {e}. Starting with empty config.")
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Config":
+        """
+        Creates a Config from an already parsed mapping, e.g. a JSON object or tomllib.loads() output.
+
+        Args:
+            data: Configuration values keyed like the TOML file.
+        """
+        config = cls()
+        config.__config = dict(data)
+        return config
+
     def __get_config_value(self, key: str, default: Any = None) -> Any:
         """
         Helper method to safely get a configuration value by key.
@@ -90,6 +102,26 @@ class Config:
         """Sets the selected TTF font file path."""
         self.__config["ttf_selector"] = value
 
+    @property
+    def ttf_index(self) -> int | None:
+        """Face index of the selected font inside a font collection (.ttc)."""
+        return self.__get_config_value("ttf_index")
+
+    @ttf_index.setter
+    def ttf_index(self, value: int):
+        """Sets the face index of the selected font."""
+        self.__config["ttf_index"] = value
+
+    @property
+    def fallback_fonts(self) -> list | None:
+        """Fallback font paths (or [path, index] pairs) used for characters the selected font lacks."""
+        return self.__get_config_value("fallback_fonts")
+
+    @fallback_fonts.setter
+    def fallback_fonts(self, value: list):
+        """Sets the fallback font chain; an empty list disables fallback."""
+        self.__config["fallback_fonts"] = value
+
     @property
     def font_size(self) -> int | None:
         """Font size."""
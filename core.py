@@ -1,9 +1,93 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+from functools import partial
 from pathlib import Path
 
 from PIL import Image, ImageFont
 from handright import Template, handwrite
-from tools import BasicTools
+from glyph_engine import GlyphRenderer
+from layout import draw_draft, layout_pages
+from numpy_engine import NumpyRenderer
+from profiling import RenderResult, RenderStats, profiled
+from shared_pages import SharedPagePool, write_page
+from tiled import SizedTemplate, TiledPageRenderer
+from fonts import default_registry, resolve_coverage
+from tools import LRUCache, StableSeed
+from writers import Colorizer, PageFormat, PdfStreamWriter, Pyramid, encode_pdf_page, write_pages
+
+SEED = StableSeed("outpus")  # 固定随机种子, 相同输入在任意进程中都得到相同的排版与笔迹
+PAGE_MANIFEST = ".pages.json"  # 增量渲染时记录每页内容摘要的清单文件
+PDF_BASE_DPI = 80  # x1 时纸张像素对应的分辨率, 默认 667x945 px 约为 A4
+# 页面以 "L" 覆盖度掩码渲染, 颜色只在编码前由 writers.Colorizer 着色, 因此不影响模板
+_COLOR_PARAMS = ("default_fill", "default_background")
+
+logger = logging.getLogger("handwrite")
+
+# 已解析字体缓存, 键为 (字体路径, 修改时间, 像素大小)
+_font_cache = LRUCache(max_items=32)
+# 已构建模板缓存, 键为模板参数; 以背景图占用的内存计量, 默认上限 1 GiB
+_template_cache = LRUCache(max_items=8, max_bytes=1 << 30,
+                           sizeof=lambda template: _image_nbytes(template.get_background()))
+
+# 多进程渲染时每个工作进程持有的渲染器与输出目录 (由 _init_render_worker 初始化)
+_worker_renderer = None
+_worker_output_dir = None
+_worker_page_format = None
+_worker_encoder = None
+_worker_colorizer = None
+
+
+def _image_nbytes(im):
+    return im.width * im.height * len(im.getbands())
+
+
+def load_font(font_path, size, index=0):
+    """按 (路径, 修改时间, 大小, 字体索引) 缓存 ImageFont.truetype 的结果, 字体文件被替换后自动失效."""
+    key = (font_path, os.path.getmtime(font_path), size, index)
+    font = _font_cache.get(key)
+    if font is None:
+        font = ImageFont.truetype(font_path, size=size, index=index)
+        _font_cache.put(key, font)
+    return font
+
+
+def _init_render_worker(renderer, output_dir, page_format, encoder=None, colorizer=None):
+    global _worker_renderer, _worker_output_dir, _worker_page_format, _worker_encoder, _worker_colorizer
+    _worker_renderer = renderer
+    _worker_output_dir = output_dir
+    _worker_page_format = page_format
+    _worker_encoder = encoder
+    _worker_colorizer = colorizer
+
+
+def _render_page(page):
+    # 未给定 encoder 时把覆盖度掩码传回主进程着色, 序列化的数据量只有 RGBA 页面的 1/4
+    mask = _worker_renderer(page)
+    return page.num, mask if _worker_encoder is None else _worker_encoder(_worker_colorizer(mask))
+
+
+def _render_page_shared(task):
+    # 把覆盖度掩码写入主进程分配的共享内存块, 只传回块名, 主进程原地读取后回收该块
+    page, block = task
+    mask = _worker_renderer(page)
+    write_page(block, mask)
+    return page.num, block, mask.size
+
+
+def _render_page_to_file(page):
+    # 在工作进程内完成渲染、着色与保存, 只把路径传回主进程, 避免整页图片的序列化开销
+    mask = _worker_renderer(page)
+    save_path = _worker_page_format.page_path(_worker_output_dir, page.num)
+    _worker_page_format.save(_worker_colorizer(mask), save_path)
+    return page.num, save_path
 
 
 class handwrite_generator(object):
@@ -12,7 +96,10 @@ class handwrite_generator(object):
             "rate": 4,  # 图片缩放比例
             "default_paper_x": 667,  # 默认纸张宽度 px
             "default_paper_y": 945,  # 默认纸张高度 px
-            "default_font": BasicTools.get_ttf_file_path()[1][0],  # 默认字体文件路径
+            "default_font": default_registry()[0].path,  # 默认字体文件路径
+            "default_font_index": 0,  # 字体集合 (.ttc) 中的字体索引
+            # 后备字体路径列表 (或 (路径, 索引)), 按顺序补全所选字体缺少的字符; None 表示 ttf_library 中的其余字体
+            "default_fallback_fonts": None,
             "default_img_output_path": "outputs",  # 默认图片输出路径
             "default_font_size": 30,  # 默认字体大小
             "default_line_spacing": 70,  # 默认行间距 px
@@ -33,52 +120,557 @@ class handwrite_generator(object):
             "default_fill": (0, 0, 0, 255),  # 默认字体填充颜色 (黑色)
         }
         self.template = None    # 模板
+        self.render_cache = None    # 可选的 render_cache.RenderCache, 命中时直接从磁盘复制整篇文档的页面
+        # ((文本, 模板), 已排版的页面, 排版生成器): 按页分发任务时同一文档的后续任务接着上次的排版继续
+        self._layouts = None
+
+    # config.Config 属性与 template_params 键的对应关系
+    config_param_keys = {
+        "width": "default_paper_x",
+        "height": "default_paper_y",
+        "ttf_selector": "default_font",
+        "ttf_index": "default_font_index",
+        "fallback_fonts": "default_fallback_fonts",
+        "font_size": "default_font_size",
+        "line_spacing": "default_line_spacing",
+        "char_distance": "default_word_spacing",
+        "margin_top": "default_top_margin",
+        "margin_bottom": "default_bottom_margin",
+        "margin_left": "default_left_margin",
+        "margin_right": "default_right_margin",
+        "char_color": "default_fill",
+        "background_color": "default_background",
+        "resolution": "rate",
+        "line_spacing_sigma": "default_line_spacing_sigma",
+        "font_size_sigma": "default_font_size_sigma",
+        "word_spacing_sigma": "default_word_spacing_sigma",
+        "perturb_x_sigma": "default_perturb_x_sigma",
+        "perturb_y_sigma": "default_perturb_y_sigma",
+        "perturb_theta_sigma": "default_perturb_theta_sigma",
+    }
+
+    def apply_config(self, config):
+        """将 config.Config 中已设置的值写入 template_params, 模板在下次渲染时重建."""
+        for attr, key in self.config_param_keys.items():
+            value = getattr(config, attr)
+            if value is not None:
+                # TOML 中的颜色以数组形式保存
+                self.template_params[key] = tuple(value) if isinstance(value, list) else value
+        if config.ttf_selector is not None and config.ttf_index is None:
+            self.template_params["default_font_index"] = 0  # 旧配置文件未记录字体索引
+        self.template = None
 
     def modify_template_params(self, **kwargs):
         for key, value in kwargs.items():
             self.template_params[key] = value
-        self.generate_template()
+        # 模板在下次渲染时按需构建, 其耗时计入渲染统计; 分带渲染也不会因此分配整页背景
+        self.template = None
 
     def generate_template(self):
-        rate = self.template_params["rate"]
-        self.template = Template(
-            background=Image.new(mode="RGBA", size=(
-                self.template_params["default_paper_x"] * rate,
-                self.template_params["default_paper_y"] * rate),
-                                 color=self.template_params["default_background"]),
-            font=ImageFont.truetype(self.template_params["default_font"],
-                                    size=self.template_params["default_font_size"] * rate),
-            line_spacing=self.template_params["default_line_spacing"] * rate,
-            fill=self.template_params["default_fill"],
-            left_margin=self.template_params["default_left_margin"] * rate,
-            top_margin=self.template_params["default_top_margin"] * rate,
-            right_margin=self.template_params["default_right_margin"] * rate,
-            bottom_margin=self.template_params["default_bottom_margin"] * rate,
-            word_spacing=self.template_params["default_word_spacing"] * rate,
-            line_spacing_sigma=self.template_params["default_line_spacing_sigma"] * rate,
-            font_size_sigma=self.template_params["default_font_size_sigma"] * rate,
-            word_spacing_sigma=self.template_params["default_word_spacing_sigma"] * rate,
-            start_chars=self.template_params["default_start_chars"],
-            end_chars=self.template_params["default_end_chars"],
-            perturb_x_sigma=self.template_params["default_perturb_x_sigma"],
-            perturb_y_sigma=self.template_params["default_perturb_y_sigma"],
-            perturb_theta_sigma=self.template_params["default_perturb_theta_sigma"]
+        self.template = self._get_template(self.template_params)
+
+    @staticmethod
+    def _params_key(params):
+        return repr(sorted(params.items())), os.path.getmtime(params["default_font"])
+
+    def _get_template(self, params, tiled=False):
+        # 参数与字体文件都未变化时直接复用已构建的模板, 跳过字体解析和整页背景的分配; 颜色不影响模板
+        key = (self._params_key({k: v for k, v in params.items() if k not in _COLOR_PARAMS}), tiled)
+        template = _template_cache.get(key)
+        if template is None:
+            template = self._build_template(params, tiled)
+            _template_cache.put(key, template)
+        return template
+
+    @staticmethod
+    def _build_template(params, tiled=False):
+        # 模板渲染 "L" 覆盖度掩码: 背景为 0, 墨迹为 255, 工作内存只有 RGBA 页面的 1/4
+        rate = params["rate"]
+        size = (params["default_paper_x"] * rate, params["default_paper_y"] * rate)
+        if tiled:
+            # 分带渲染不需要整页背景, 只记录页面尺寸
+            template_class = partial(SizedTemplate, size)
+            background = Image.new(mode="L", size=(1, 1), color=0)
+        else:
+            template_class = Template
+            background = Image.new(mode="L", size=size, color=0)
+        return template_class(
+            background=background,
+            font=load_font(params["default_font"],
+                           size=params["default_font_size"] * rate, index=params["default_font_index"]),
+            line_spacing=params["default_line_spacing"] * rate,
+            fill=255,
+            left_margin=params["default_left_margin"] * rate,
+            top_margin=params["default_top_margin"] * rate,
+            right_margin=params["default_right_margin"] * rate,
+            bottom_margin=params["default_bottom_margin"] * rate,
+            word_spacing=params["default_word_spacing"] * rate,
+            line_spacing_sigma=params["default_line_spacing_sigma"] * rate,
+            font_size_sigma=params["default_font_size_sigma"] * rate,
+            word_spacing_sigma=params["default_word_spacing_sigma"] * rate,
+            start_chars=params["default_start_chars"],
+            end_chars=params["default_end_chars"],
+            perturb_x_sigma=params["default_perturb_x_sigma"],
+            perturb_y_sigma=params["default_perturb_y_sigma"],
+            perturb_theta_sigma=params["default_perturb_theta_sigma"]
         )
 
-    def generate_image(self, text):
-        temp_file_path_dict = {}
-        if self.template is None:
-            self.generate_template()
-        images = handwrite(text, self.template, "outpus")
-        output_dir = Path("outputs")
+    @staticmethod
+    def _colorizer(params):
+        return Colorizer(params["default_background"], params["default_fill"])
+
+    def iter_images(self, text, workers=1, save=True, cancel_event=None, output_dir=None, tiled=False,
+                    engine="handright", incremental=False, image_format="png", compress_level=6, stats=None,
+                    page_numbers=None, mp_context=None):
+        """
+        逐页渲染 text, 每页完成后立即产出 (页码, 路径); save=False 时产出 (页码, PIL 图片) 且不写盘.
+
+        页面按页码顺序产出, 调用方可以在后续页面仍在渲染时开始处理前面的页面.
+        串行模式下除调用方持有的页面外, 同一时刻只保留一张整页图片.
+        workers > 1 时使用进程池并行渲染各页; 排版仍在主进程中按顺序进行,
+        每页的随机扰动由 handright 按 (seed, 页码) 独立播种, 因此输出与串行结果逐像素一致.
+        workers 为 None 时使用全部 CPU 核心. 提前关闭生成器会终止进程池.
+        cancel_event (threading.Event) 被置位后生成器尽快结束: 进程池模式下立即终止正在渲染的页面,
+        串行模式下在当前页完成后停止.
+        output_dir 默认为 template_params["default_img_output_path"].
+        tiled=True 时按行带渲染并流式写入 PNG (见 tiled.py), 峰值内存与倍率无关, 适用于 x32/x64;
+        输出与常规渲染逐像素一致, 但只能写盘.
+        engine="glyph" 使用字形缓存渲染引擎 (见 glyph_engine.py): 排版与 handright 完全相同,
+        笔画扰动统计上等价但不逐像素一致, 重复字符越多加速越明显.
+        engine="numpy" 以 NumPy 数组运算提取并扰动整页笔画 (见 numpy_engine.py), 与 handright 逐像素一致, 需要安装 NumPy.
+        incremental=True 时先排版全文, 与 output_dir 中上次导出记录的每页内容摘要 (.pages.json) 比较,
+        只重新渲染内容、排版或参数发生变化的页面, 其余页面直接复用已有文件.
+        设置了 self.render_cache 且 save=True 时, 相同的 (文本, 参数, 字体文件内容, 种子) 直接从缓存复制.
+        image_format 为 "png", "tiff" (不压缩, 写入最快) 或 "webp" (无损), compress_level 为 PNG 压缩级别 (0-9);
+        串行模式下页面由后台线程编码写盘, 与下一页的渲染重叠进行. 分带渲染只支持 PNG.
+        给定 stats (profiling.RenderStats) 时记录字体加载、模板构建、排版、渲染和编码各阶段及每页的耗时与内存变化.
+        给定 page_numbers 时只渲染其中的页码, 结果与完整导出中的对应页面一致 (用于按页分发任务);
+        排版只进行到其中最大的页码, 已排版的页面保留到下一次以相同文本与参数调用时继续使用.
+        mp_context 为创建进程池的 multiprocessing 上下文, 默认使用平台默认的启动方式;
+        在多线程的程序 (例如 Qt 界面) 中应传入 spawn 上下文, fork 会复制其他线程持有的锁.
+        """
+        if incremental and page_numbers is not None:
+            raise ValueError("incremental rendering cannot be restricted to page_numbers")
+        if incremental and not save:
+            raise ValueError("incremental rendering reuses pages on disk and needs save=True")
+        if tiled and not save:
+            raise ValueError("tiled rendering always writes pages to disk")
+        if engine not in ("handright", "glyph", "numpy"):
+            raise ValueError(f"unknown render engine: {engine}")
+        if tiled and engine != "handright":
+            raise ValueError("tiled rendering only supports the handright engine")
+        page_format = PageFormat(image_format, compress_level)
+        if tiled and image_format != "png":
+            raise ValueError("tiled rendering only writes PNG files")
+        output_dir = Path(output_dir or self.template_params["default_img_output_path"])
+        stats = stats if stats is not None else RenderStats()
+        template = self._timed_template(stats, tiled)
+        with stats.stage("coverage"):
+            fallback = self._load_fallback(text, self.template_params)
+        if incremental:
+            pages = self._iter_pages_incremental(template, text, output_dir, workers, cancel_event, tiled, engine,
+                                                 page_format, stats, fallback, mp_context)
+        elif page_numbers is not None:
+            page_numbers = set(page_numbers)
+            with stats.stage("layout"):
+                layouts = [layout for layout in self._layouts_until(template, text, fallback, max(page_numbers))
+                           if layout.num in page_numbers]
+            return self._iter_pages(template, text, output_dir, workers, save, cancel_event, tiled, engine, layouts,
+                                    page_format, stats=stats, fallback=fallback,
+                                    colorizer=self._colorizer(self.template_params), mp_context=mp_context)
+        else:
+            pages = self._iter_pages(template, text, output_dir, workers, save, cancel_event, tiled, engine,
+                                     page_format=page_format, stats=stats, fallback=fallback,
+                                     colorizer=self._colorizer(self.template_params), mp_context=mp_context)
+        if self.render_cache is not None and save:
+            return self._iter_cached(template, text, output_dir, engine, cancel_event, pages, page_format, stats,
+                                     fallback)
+        return pages
+
+    def _layouts_until(self, template, text, fallback, last):
+        # 排版到第 last 页为止; 文本或模板 (由参数缓存得到) 变化时从头排版, 否则从上次停下的页面继续
+        key = (text, template)
+        if self._layouts is None or self._layouts[0] != key:
+            self._layouts = (key, [], layout_pages(text, template, SEED, fallback))
+        _, layouts, pending = self._layouts
+        while len(layouts) <= last:
+            layout = next(pending, None)
+            if layout is None:
+                break
+            layouts.append(layout)
+        return layouts
+
+    def check_coverage(self, text):
+        """
+        渲染前检查 text 的每个字符是否在所选字体的字符映射表中, 缺少的字符依次在后备字体中查找.
+        只做集合查找, 不光栅化任何字形.
+
+        Returns:
+            (fallback, missing): {字符: fonts.FontInfo} 为由后备字体补全的字符, missing 为所有字体都缺少的字符列表.
+        """
+        params = self.template_params
+        registry = default_registry()
+        font = registry.info(params["default_font"], params["default_font_index"])
+        chain = params["default_fallback_fonts"]
+        if chain is None:
+            chain = [f for f in registry if (os.path.normpath(f.path), f.index) != (os.path.normpath(font.path),
+                                                                                   font.index)]
+        else:
+            chain = [registry.info(*entry) if isinstance(entry, (list, tuple)) else registry.info(entry)
+                     for entry in chain]
+        return resolve_coverage(text, font, chain)
+
+    def _load_fallback(self, text, params):
+        # 返回 {字符: 与模板字号相同的后备字体}, 所选字体覆盖全部字符时为空, 渲染结果与 handright 完全一致
+        fallback, missing = self.check_coverage(text)
+        if missing:
+            logger.warning("no font covers %d character(s): %s", len(missing), "".join(missing[:50]))
+        size = params["default_font_size"] * params["rate"]
+        return {char: load_font(info.path, size=size, index=info.index) for char, info in fallback.items()}
+
+    def _timed_template(self, stats, tiled=False):
+        # 先单独加载字体, 以便区分字体解析与整页背景分配的耗时 (模板构建时字体已在缓存中)
+        params = self.template_params
+        with stats.stage("font"):
+            load_font(params["default_font"], size=params["default_font_size"] * params["rate"],
+                      index=params["default_font_index"])
+        with stats.stage("template"):
+            if tiled:
+                return self._get_template(params, tiled=True)
+            if self.template is None:
+                self.generate_template()
+            return self.template
+
+    def _iter_cached(self, template, text, output_dir, engine, cancel_event, pages, page_format, stats, fallback):
+        key = self.render_cache.make_key(text, self.template_params, SEED, engine, page_format.image_format,
+                                         {char: (font.path, font.index) for char, font in fallback.items()},
+                                         page_format.compress_level)
+        with stats.stage("cache_lookup"):
+            cached = self.render_cache.get(key)
+        if cached is not None and self._copy_cached(template, text, output_dir, engine, cached, page_format, stats,
+                                                    fallback):
+            pages.close()
+            for i in range(len(cached)):
+                yield i, page_format.page_path(output_dir, i)
+            return
+        rendered = []
+        for i, save_path in pages:
+            rendered.append(save_path)
+            yield i, save_path
+        if cancel_event is None or not cancel_event.is_set():
+            with stats.stage("cache_store"):
+                self.render_cache.put(key, rendered)
+
+    def _copy_cached(self, template, text, output_dir, engine, cached, page_format, stats, fallback):
+        # 将缓存的页面复制到输出目录并重写增量清单, 下次增量导出只需重新渲染变化的页面;
+        # 条目在复制过程中被其他进程淘汰时返回 False, 由调用方改为渲染
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for i, cached_path in enumerate(cached):
+            try:
+                stats.call("cache_copy", i, shutil.copyfile, cached_path, page_format.page_path(output_dir, i))
+            except FileNotFoundError:
+                return False
+        for path in output_dir.iterdir():
+            match = re.fullmatch(r"(\d+)" + re.escape(page_format.suffix), path.name)
+            if match and int(match.group(1)) >= len(cached):
+                path.unlink()
+        with stats.stage("layout"):
+            layouts = list(layout_pages(text, template, SEED, fallback))
+        digests = self._page_digests(layouts, engine, page_format, fallback)
+        with open(output_dir.joinpath(PAGE_MANIFEST), "w", encoding="utf-8") as f:
+            json.dump({str(num): digest for num, digest in digests.items()}, f)
+        return True
+
+    def _page_digests(self, layouts, engine, page_format, fallback):
+        # 增量渲染清单中每页的内容摘要, 由参数、后备字体、引擎、格式、种子和该页的排版决定
+        params_key = self._params_key(self.template_params)
+        fallback_key = sorted((char, font.path, font.index) for char, font in fallback.items())
+        digests = {}
+        for layout in layouts:
+            content = repr((params_key, fallback_key, engine, page_format.image_format, hash(SEED), layout.num,
+                            layout.glyphs))
+            digests[layout.num] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return digests
+
+    @staticmethod
+    def _iter_pages(template, text, output_dir, workers=1, save=True, cancel_event=None, tiled=False,
+                    engine="handright", layouts=None, page_format=None, encoder=None, stats=None, fallback=None,
+                    colorizer=None, mp_context=None):
+        # layouts 不为 None 时只渲染给定的页面 (增量渲染), 否则渲染整篇文本;
+        # save=False 且给定 encoder 时产出 encoder(图片), 进程池模式下在工作进程内编码;
+        # fallback ({字符: 后备字体}) 非空时由 layout.py 排版并绘制草稿, 缺字使用后备字体;
+        # 渲染器产出 "L" 覆盖度掩码, 由 colorizer (writers.Colorizer) 在编码前或产出前着色;
+        # 进程池由 mp_context (默认为 multiprocessing 模块本身) 创建
+        page_format = page_format or PageFormat()
+        stats = stats if stats is not None else RenderStats()
+        if save:
+            output_dir.mkdir(parents=True, exist_ok=True)
+        if layouts is not None and not layouts:
+            return  # 没有需要渲染的页面, 不启动进程池
+        if tiled:
+            # 分带渲染器按字形位置逐块绘制并扰动, 直接把页面流式写入 PNG, 不分配整页草稿
+            renderer = TiledPageRenderer(template, hash(SEED), output_dir, colorizer, fallback,
+                                         compress_level=page_format.compress_level)
+            pages = layout_pages(text, template, SEED, fallback) if layouts is None else iter(layouts)
+        elif engine == "glyph":
+            renderer = GlyphRenderer(template, hash(SEED), fallback)
+            pages = layout_pages(text, template, SEED, fallback) if layouts is None else iter(layouts)
+        elif layouts is None and not fallback:
+            # 借助 mapper 参数取出 handright 的渲染器和按需排版的页面草稿
+            renderer, pages = handwrite(text, template, SEED, mapper=lambda r, p: (r, p))
+        else:
+            renderer = handwrite("", template, SEED, mapper=lambda r, p: r)
+            if layouts is None:
+                layouts = layout_pages(text, template, SEED, fallback)
+            pages = (draw_draft(layout, template, fallback) for layout in layouts)
+        if engine == "numpy":
+            renderer = NumpyRenderer(template, hash(SEED))
+        # handright 的页面在迭代时才排版并绘制草稿
+        pages = stats.timed(pages, "layout")
+
+        if workers == 1:
+            def render_pages():
+                for page in pages:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    yield page.num, stats.call("render", page.num, renderer, page)
+
+            if tiled:
+                for _, item in render_pages():
+                    yield item
+            elif save:
+                # 后台线程着色、编码并写盘, 同时渲染下一页
+                yield from write_pages(((num, mask, page_format.page_path(output_dir, num))
+                                        for num, mask in render_pages()), page_format, stats=stats,
+                                       colorize=colorizer)
+            elif encoder is not None:
+                for num, mask in render_pages():
+                    encoded = stats.call("encode", num, lambda m: encoder(colorizer(m)), mask)
+                    del mask  # 在渲染下一页之前释放当前页
+                    yield num, encoded
+            else:
+                for num, mask in render_pages():
+                    yield num, stats.call("colorize", num, colorizer, mask)
+            return
+
+        # 整页掩码经共享内存块交给主进程着色; 块的数量固定, 只有空闲块时才派发下一页, 内存占用不随批次增长
+        shared = not tiled and not save and encoder is None
+        buffers = None
+        stop = threading.Event()
+        if shared:
+            # 先于进程池创建共享内存, fork 出的工作进程与主进程共用同一个 resource_tracker
+            width, height = template.get_size()
+            buffers = SharedPagePool(width * height, count=2 * workers)
+
+            def lease_blocks(drafts):
+                # imap 在后台线程中取任务, 没有空闲块时在这里等待主进程回收
+                for page in drafts:
+                    block = buffers.acquire(stop)
+                    if block is None:
+                        return
+                    yield page, block
+
+            pages = lease_blocks(pages)
+        context = mp_context or multiprocessing
+        try:
+            if tiled:
+                render_page = renderer
+                pool = context.Pool(workers)
+            else:
+                render_page = _render_page_shared if shared else _render_page_to_file if save else _render_page
+                pool = context.Pool(workers, initializer=_init_render_worker,
+                                    initargs=(renderer, output_dir, page_format, encoder, colorizer))
+            with pool:
+                try:
+                    results = pool.imap(render_page, pages)
+                    # 工作进程内的各阶段不可见, 每页记录从上一页产出到该页到达的等待时间
+                    start = time.perf_counter()
+                    while cancel_event is None or not cancel_event.is_set():
+                        try:
+                            item = results.next(timeout=0.1)
+                        except multiprocessing.TimeoutError:
+                            continue
+                        except StopIteration:
+                            return
+                        stats.record("render", time.perf_counter() - start, page=item[0])
+                        if shared:
+                            num, block, size = item
+                            item = num, stats.call("colorize", num, buffers.read, block, size, colorizer)
+                        yield item
+                        start = time.perf_counter()
+                finally:
+                    # 先让等待空闲块的任务线程退出, 进程池结束时才能回收该线程
+                    stop.set()
+        finally:
+            if buffers is not None:
+                buffers.close()
+
+    def _iter_pages_incremental(self, template, text, output_dir, workers, cancel_event, tiled, engine, page_format,
+                                stats, fallback, mp_context=None):
+        # 先做一遍只排版不渲染的预处理, 按每页的内容摘要与上次导出的清单比较, 只重新渲染变化的页面
+        with stats.stage("layout"):
+            layouts = list(layout_pages(text, template, SEED, fallback))
+        manifest_path = output_dir.joinpath(PAGE_MANIFEST)
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                old_digests = json.load(f)
+        except (OSError, ValueError):
+            old_digests = {}
+        digests = self._page_digests(layouts, engine, page_format, fallback)
+        stale = [layout for layout in layouts
+                 if old_digests.get(str(layout.num)) != digests[layout.num]
+                 or not page_format.page_path(output_dir, layout.num).exists()]
+
         output_dir.mkdir(parents=True, exist_ok=True)
-        for i, im in enumerate(images):
-            assert isinstance(im, Image.Image)
-            save_path = output_dir.joinpath(f"{i}.png")
-            temp_file_path_dict[i] = save_path
-            im.save(save_path)
+        # 删除页数减少后多余的旧页面
+        for num in old_digests:
+            if int(num) >= len(layouts):
+                page_format.page_path(output_dir, num).unlink(missing_ok=True)
+        done = {num: digest for num, digest in old_digests.items() if int(num) < len(layouts)}
+        for layout in stale:
+            done.pop(str(layout.num), None)
+        rendered = self._iter_pages(template, text, output_dir, workers, True, cancel_event, tiled, engine, stale,
+                                    page_format, stats=stats, fallback=fallback,
+                                    colorizer=self._colorizer(self.template_params), mp_context=mp_context)
+        try:
+            stale_nums = {layout.num for layout in stale}
+            for layout in layouts:
+                if layout.num in stale_nums:
+                    item = next(rendered, None)
+                    if item is None:
+                        return  # 已取消
+                    done[str(layout.num)] = digests[layout.num]
+                    yield item
+                else:
+                    yield layout.num, page_format.page_path(output_dir, layout.num)
+        finally:
+            rendered.close()
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(done, f)
+
+    def paginate(self, text):
+        """
+        只排版不渲染, 返回每页在 layout.preprocess_text(text) 中的文本范围 [(start, end), ...].
+
+        分页与 iter_images 的导出结果完全一致, 但只用到字体的字宽度量, 不分配整页图片,
+        耗时通常在毫秒级. 可用于提前得到页数, 或把各页分派给独立的渲染进程.
+        """
+        # 分带模板只携带 1x1 背景, 避免为排版分配整页图片
+        template = self._get_template(self.template_params, tiled=True)
+        fallback = self._load_fallback(text, self.template_params)
+        return [(page.start, page.end) for page in layout_pages(text, template, SEED, fallback)]
+
+    def generate_image(self, text, workers=1, in_memory=False, output_dir=None, tiled=False, engine="handright",
+                       incremental=False, image_format="png", compress_level=6, profile=None):
+        """
+        渲染 text 并逐页保存为图片 (默认 PNG), 返回 {页码: 路径}; in_memory=True 时不写盘, 返回 {页码: PIL 图片}.
+        返回值为 profiling.RenderResult, 其 stats 属性记录各阶段及每页的耗时与内存变化, 同时输出到
+        handwrite.stats 日志. profile 为文件路径时在 cProfile 下渲染并将统计结果写入该文件.
+        其余参数的含义见 iter_images.
+        """
+        stats = RenderStats()
+        temp_file_path_dict = RenderResult()
+        with profiled(profile):
+            for i, page in self.iter_images(text, workers=workers, save=not in_memory, output_dir=output_dir,
+                                            tiled=tiled, engine=engine, incremental=incremental,
+                                            image_format=image_format, compress_level=compress_level, stats=stats):
+                temp_file_path_dict[i] = page
+        temp_file_path_dict.stats = stats.as_dict()
+        stats.log(rate=self.template_params["rate"], engine=engine, workers=workers)
         return temp_file_path_dict
 
+    def generate_pyramid(self, text, rates, workers=1, output_dir=None, engine="handright", image_format="png",
+                         compress_level=6, cancel_event=None, profile=None):
+        """
+        只以 rates 中最高的倍率渲染一次 text, 较低倍率由同一页的掩码逐级缩小得到 (见 writers.Pyramid),
+        各倍率的页面保存到 output_dir 下的 x{倍率} 子目录, 返回 {倍率: {页码: 路径}}.
+
+        所有倍率的笔迹完全相同, 只是分辨率不同; 而分别以各倍率导出时, 扰动的像素取整会使笔迹略有差异.
+        各倍率页面的着色、编码与写盘在后台线程中并行进行, 同时渲染下一页.
+        self.template_params["rate"] 不参与导出, 其余参数的含义见 iter_images 与 generate_image.
+        """
+        # 进程池模式下掩码是共享内存块的视图, 读取后该块即被回收, 最高倍率须复制一份
+        pyramid = Pyramid(rates, copy_top=workers != 1)
+        params = dict(self.template_params, rate=pyramid.rates[0])
+        output_dir = Path(output_dir or params["default_img_output_path"])
+        level_dirs = {rate: output_dir.joinpath(f"x{rate}") for rate in pyramid.rates}
+        rate_of_dir = {level_dir: rate for rate, level_dir in level_dirs.items()}
+        for level_dir in level_dirs.values():
+            level_dir.mkdir(parents=True, exist_ok=True)
+        page_format = PageFormat(image_format, compress_level)
+        stats = RenderStats()
+        result = RenderResult((rate, {}) for rate in pyramid.rates)
+        with profiled(profile):
+            with stats.stage("template"):
+                template = self._get_template(params)
+            with stats.stage("coverage"):
+                fallback = self._load_fallback(text, params)
+            # 以 pyramid 代替着色器, 每页产出 {倍率: 掩码}, 进程池模式下在主进程中缩小
+            pages = self._iter_pages(template, text, None, workers, False, cancel_event, engine=engine, stats=stats,
+                                     fallback=fallback, colorizer=pyramid)
+            variants = ((num, mask, page_format.page_path(level_dirs[rate], num))
+                        for num, levels in pages for rate, mask in levels.items())
+            written = write_pages(variants, page_format, threads=len(level_dirs), max_pending=2 * len(level_dirs),
+                                  stats=stats, colorize=self._colorizer(params))
+            for num, path in written:
+                result[rate_of_dir[path.parent]][num] = path
+        result.stats = stats.as_dict()
+        stats.log(rate=pyramid.rates[0], engine=engine, workers=workers, output="pyramid", rates=pyramid.rates)
+        return result
+
+    def generate_pdf(self, text, pdf_path=None, workers=1, cancel_event=None, engine="handright",
+                     compress_level=6, profile=None):
+        """
+        渲染 text 并直接写入一个多页 PDF, 返回 RenderResult {页码: PDF 路径} (stats 为各阶段统计);
+        被 cancel_event 取消时删除未完成的文件并返回 None.
+
+        页面按 PDF_BASE_DPI * rate 的分辨率嵌入, 因此打印尺寸只由纸张像素决定, 与倍率无关
+        (默认 667x945 约为 A4). 每页只压缩一次 (进程池模式下在工作进程内完成) 后立即写出,
+        主进程同一时刻最多持有一页图片. pdf_path 默认为 default_img_output_path 下的 handwrite.pdf.
+        各阶段耗时输出到 handwrite.stats 日志, profile 的含义见 generate_image.
+        """
+        pdf_path = Path(pdf_path or Path(self.template_params["default_img_output_path"], "handwrite.pdf"))
+        pdf_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = pdf_path.with_name(pdf_path.name + ".part")
+        encoder = partial(encode_pdf_page, compress_level=compress_level)
+        stats = RenderStats()
+        result = RenderResult()
+        with profiled(profile):
+            template = self._timed_template(stats)
+            with stats.stage("coverage"):
+                fallback = self._load_fallback(text, self.template_params)
+            pages = self._iter_pages(template, text, None, workers, False, cancel_event, engine=engine,
+                                     encoder=encoder, stats=stats, fallback=fallback,
+                                     colorizer=self._colorizer(self.template_params))
+            try:
+                with PdfStreamWriter(partial_path, PDF_BASE_DPI * self.template_params["rate"]) as writer:
+                    for num, page in pages:
+                        stats.call("write", num, writer.add_page, page)
+                        result[num] = pdf_path
+            except BaseException:
+                # 渲染或编码出错 (包括 Ctrl+C) 时不留下未完成的文件
+                partial_path.unlink(missing_ok=True)
+                raise
+        result.stats = stats.as_dict()
+        stats.log(rate=self.template_params["rate"], engine=engine, workers=workers, output="pdf")
+        if cancel_event is not None and cancel_event.is_set():
+            partial_path.unlink()
+            return None
+        os.replace(partial_path, pdf_path)
+        return result
+
+    def generate_preview(self, text, preview_rate=1):
+        """
+        以 preview_rate (默认 x1, 也可传入视图的设备像素比) 在内存中渲染预览图, 返回 {页码: PIL 图片}, 不写盘.
+
+        预览与导出使用相同的参数和随机种子, 排版 (分页与换行) 与导出结果一致 (仅在换行临界处可能因取整产生差异),
+        而渲染开销只有导出的 1/rate². 笔画扰动以缩放后的像素为单位, 因此预览与导出的笔迹细节并不逐笔相同.
+        """
+        params = dict(self.template_params, rate=preview_rate)
+        template = self._get_template(params)
+        return dict(self._iter_pages(template, text, None, save=False, fallback=self._load_fallback(text, params),
+                                     colorizer=self._colorizer(params)))
+
 
 if __name__ == '__main__':
     generator = handwrite_generator()
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed font registry.
+
+Scans a font folder once and keeps an index of every face in it (name, family, path, face index,
+supported codepoints and vertical metrics) in a JSON file under the user cache folder. On later
+runs the index is reused as long as the size and modification time of every font file are
+unchanged, so startup only stats the font files; when the folder changed, only added or modified
+files are parsed again. TrueType (.ttf), OpenType (.otf) and collections (.ttc, one entry per face) are
+supported. The tables are read directly from the sfnt structure, without loading glyph outlines.
+"""
+import bisect
+import json
+import os
+import struct
+import threading
+import zlib
+
+FONT_SUFFIXES = (".ttf", ".otf", ".ttc")
+DEFAULT_FONT_DIR = "ttf_library"
+_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "handwrite")
+_INDEX_VERSION = 2
+# 不绘制任何字形的字符, 不参与覆盖检查
+_IGNORED_CHARS = frozenset("\r\n")
+
+
+class FontInfo(object):
+    """
+    One font face.
+
+    Attributes:
+        name: Display name, the file name without suffix (with the family appended for collections).
+        path: Path of the font file.
+        index: Face index inside the file, 0 except for collections.
+        family: Family name from the font's name table.
+        style: Subfamily name, e.g. "Regular".
+        units_per_em, ascender, descender: Vertical metrics in font units.
+    """
+    __slots__ = ("name", "path", "index", "family", "style", "units_per_em", "ascender", "descender",
+                 "_starts", "_ends")
+
+    def __init__(self, name, path, index, family, style, units_per_em, ascender, descender, ranges):
+        self.name = name
+        self.path = path
+        self.index = index
+        self.family = family
+        self.style = style
+        self.units_per_em = units_per_em
+        self.ascender = ascender
+        self.descender = descender
+        self._starts = [start for start, _ in ranges]
+        self._ends = [end for _, end in ranges]
+
+    def covers(self, char):
+        """Whether the font's character map has a glyph for char (a single character or a codepoint)."""
+        codepoint = char if isinstance(char, int) else ord(char)
+        i = bisect.bisect_right(self._starts, codepoint) - 1
+        return i >= 0 and codepoint <= self._ends[i]
+
+    @property
+    def ranges(self):
+        """Supported codepoints as sorted, inclusive (start, end) ranges."""
+        return list(zip(self._starts, self._ends))
+
+    def to_json(self):
+        return {"name": self.name, "index": self.index, "family": self.family, "style": self.style,
+                "units_per_em": self.units_per_em, "ascender": self.ascender, "descender": self.descender,
+                "ranges": self.ranges}
+
+    @classmethod
+    def from_json(cls, path, data):
+        return cls(data["name"], path, data["index"], data["family"], data["style"], data["units_per_em"],
+                   data["ascender"], data["descender"], [tuple(r) for r in data["ranges"]])
+
+    def __repr__(self):
+        return f"FontInfo(name={self.name!r}, path={self.path!r}, index={self.index})"
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated font file")
+    return data
+
+
+def _face_offsets(f):
+    tag = _read(f, 0, 4)
+    if tag == b"ttcf":
+        count, = struct.unpack(">I", _read(f, 8, 4))
+        return list(struct.unpack(f">{count}I", _read(f, 12, 4 * count)))
+    return [0]
+
+
+def _table_directory(f, offset):
+    num_tables, = struct.unpack(">H", _read(f, offset + 4, 2))
+    tables = {}
+    for i in range(num_tables):
+        tag, _, table_offset, length = struct.unpack(">4sIII", _read(f, offset + 12 + 16 * i, 16))
+        tables[tag] = (table_offset, length)
+    return tables
+
+
+def _cmap_ranges(data):
+    # 优先使用完整 Unicode 子表 (格式 12), 其次是 BMP 子表 (格式 4)
+    num_subtables, = struct.unpack(">H", data[2:4])
+    subtables = {}
+    for i in range(num_subtables):
+        platform, encoding, offset = struct.unpack(">HHI", data[4 + 8 * i:12 + 8 * i])
+        subtables[(platform, encoding)] = offset
+    for key in ((3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0)):
+        offset = subtables.get(key)
+        if offset is None:
+            continue
+        subtable_format, = struct.unpack(">H", data[offset:offset + 2])
+        if subtable_format == 12:
+            return _cmap_format12(data, offset)
+        if subtable_format == 4:
+            return _cmap_format4(data, offset)
+    return []
+
+
+def _cmap_format4(data, offset):
+    seg_count = struct.unpack(">H", data[offset + 6:offset + 8])[0] // 2
+    ends_at = offset + 14
+    starts_at = ends_at + 2 * seg_count + 2
+    deltas_at = starts_at + 2 * seg_count
+    range_offsets_at = deltas_at + 2 * seg_count
+    ends = struct.unpack(f">{seg_count}H", data[ends_at:ends_at + 2 * seg_count])
+    starts = struct.unpack(f">{seg_count}H", data[starts_at:starts_at + 2 * seg_count])
+    deltas = struct.unpack(f">{seg_count}h", data[deltas_at:deltas_at + 2 * seg_count])
+    range_offsets = struct.unpack(f">{seg_count}H", data[range_offsets_at:range_offsets_at + 2 * seg_count])
+    codepoints = []
+    for i in range(seg_count):
+        if starts[i] == 0xFFFF:
+            continue
+        if range_offsets[i] == 0:
+            # 字形号为 (码位 + delta) mod 65536, 只有映射到 0 的码位没有字形
+            codepoints.extend(c for c in range(starts[i], ends[i] + 1) if (c + deltas[i]) & 0xFFFF)
+            continue
+        for c in range(starts[i], ends[i] + 1):
+            at = range_offsets_at + 2 * i + range_offsets[i] + 2 * (c - starts[i])
+            glyph, = struct.unpack(">H", data[at:at + 2])
+            if glyph:
+                codepoints.append(c)
+    return _to_ranges(codepoints)
+
+
+def _cmap_format12(data, offset):
+    num_groups, = struct.unpack(">I", data[offset + 12:offset + 16])
+    ranges = []
+    for i in range(num_groups):
+        start, end, _ = struct.unpack(">III", data[offset + 16 + 12 * i:offset + 28 + 12 * i])
+        ranges.append((start, end))
+    return _merge_ranges(ranges)
+
+
+def _to_ranges(codepoints):
+    return _merge_ranges((c, c) for c in codepoints)
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _name_strings(data):
+    # 名称表: 优先排版名称 (16/17), 其次字族名 (1/2); 优先简体中文, 其次英文
+    count, string_offset = struct.unpack(">2xHH", data[:6])
+    found = {}
+    for i in range(count):
+        platform, encoding, language, name_id, length, offset = struct.unpack(
+            ">6H", data[6 + 12 * i:18 + 12 * i])
+        if name_id not in (1, 2, 16, 17):
+            continue
+        raw = data[string_offset + offset:string_offset + offset + length]
+        if platform == 3 or platform == 0:
+            text = raw.decode("utf-16-be", errors="replace")
+        elif platform == 1 and encoding == 0:
+            text = raw.decode("mac_roman", errors="replace")
+        else:
+            continue
+        rank = {0x804: 0, 0x409: 1}.get(language, 2) if platform == 3 else 3
+        if name_id not in found or rank < found[name_id][0]:
+            found[name_id] = (rank, text)
+    family = (found.get(16) or found.get(1) or (0, ""))[1]
+    style = (found.get(17) or found.get(2) or (0, ""))[1]
+    return family, style
+
+
+def read_font_faces(path):
+    """
+    Reads the faces of a font file.
+
+    Returns:
+        A list of FontInfo, one per face.
+
+    Raises:
+        OSError, ValueError or struct.error for unreadable or malformed files.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    faces = []
+    with open(path, "rb") as f:
+        offsets = _face_offsets(f)
+        for index, offset in enumerate(offsets):
+            tables = _table_directory(f, offset)
+            if b"cmap" not in tables:
+                raise ValueError(f"{path} has no character map")
+            ranges = _cmap_ranges(_read(f, *tables[b"cmap"]))
+            family, style = _name_strings(_read(f, *tables[b"name"])) if b"name" in tables else ("", "")
+            units_per_em = ascender = descender = 0
+            if b"head" in tables:
+                units_per_em, = struct.unpack(">H", _read(f, tables[b"head"][0] + 18, 2))
+            if b"hhea" in tables:
+                ascender, descender = struct.unpack(">hh", _read(f, tables[b"hhea"][0] + 4, 4))
+            name = stem if len(offsets) == 1 else f"{stem} ({family or index})"
+            faces.append(FontInfo(name, path, index, family, style, units_per_em, ascender, descender, ranges))
+    return faces
+
+
+class FontRegistry(object):
+    """
+    All fonts of a folder, indexed by display name, path and position.
+
+    The folder is scanned on first use. Lookups by name, path or position are dictionary or list
+    accesses; refresh() reparses only font files whose size or modification time changed.
+
+    Args:
+        root: Font folder.
+        index_path: JSON index file; defaults to a file per folder under ~/.cache/handwrite.
+    """
+
+    def __init__(self, root=DEFAULT_FONT_DIR, index_path=None):
+        self.root = root
+        if index_path is None:
+            key = zlib.crc32(os.path.abspath(root).encode("utf-8"))
+            index_path = os.path.join(_INDEX_DIR, f"fonts-{key:08x}.json")
+        self.index_path = index_path
+        self.__lock = threading.Lock()
+        self.__fonts = None
+        self.__by_name = {}
+        self.__by_path = {}
+        self.__positions = {}
+        self.__external = {}
+        self.__stats = None  # {文件名: (修改时间, 大小)}, 与上次刷新时比较
+
+    def __ensure_loaded(self):
+        if self.__fonts is None:
+            self.refresh()
+        return self.__fonts
+
+    def refresh(self):
+        """Brings the registry up to date with the folder, parsing only new or modified files."""
+        with self.__lock:
+            # 同名覆盖字体文件不改变目录的修改时间, 因此逐个比较文件的修改时间与大小
+            stats = self.__stat_files()
+            if self.__fonts is not None and stats == self.__stats:
+                return
+            index = self.__load_index()
+            previous = index["files"] if index is not None else {}
+            if {name: (entry["mtime"], entry["size"]) for name, entry in previous.items()} == stats:
+                files = previous
+            else:
+                files = self.__scan(previous, stats)
+                self.__save_index(files)
+            fonts = []
+            for file_name in sorted(files):
+                path = os.path.join(self.root, file_name)
+                fonts.extend(FontInfo.from_json(path, face) for face in files[file_name]["faces"])
+            self.__fonts = fonts
+            self.__by_name = {font.name: font for font in fonts}
+            self.__by_path = {(os.path.normpath(font.path), font.index): font for font in fonts}
+            self.__positions = {(font.path, font.index): i for i, font in enumerate(fonts)}
+            self.__stats = stats
+
+    def __stat_files(self):
+        stats = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(FONT_SUFFIXES):
+                    stat = entry.stat()
+                    stats[entry.name] = (stat.st_mtime, stat.st_size)
+        return stats
+
+    def __scan(self, previous, stats):
+        files = {}
+        for file_name, (mtime, size) in stats.items():
+            old = previous.get(file_name)
+            if old is not None and old["mtime"] == mtime and old["size"] == size:
+                files[file_name] = old
+                continue
+            path = os.path.join(self.root, file_name)
+            try:
+                faces = [face.to_json() for face in read_font_faces(path)]
+            except (OSError, ValueError, struct.error) as e:
+                # 无法读取的文件也记入索引 (没有字体), 文件不变时不再重复解析和警告
+                print(f"Warning: skipping unreadable font {path}: {e}")
+                faces = []
+            files[file_name] = {"mtime": mtime, "size": size, "faces": faces}
+        return files
+
+    def __load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get("version") != _INDEX_VERSION or index.get("root") != os.path.abspath(self.root):
+            return None
+        return index
+
+    def __save_index(self, files):
+        index = {"version": _INDEX_VERSION, "root": os.path.abspath(self.root), "files": files}
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Warning: could not save font index {self.index_path}: {e}")
+
+    @property
+    def fonts(self):
+        """All faces, sorted by file name."""
+        return list(self.__ensure_loaded())
+
+    @property
+    def names(self):
+        return [font.name for font in self.__ensure_loaded()]
+
+    @property
+    def paths(self):
+        return [font.path for font in self.__ensure_loaded()]
+
+    def __len__(self):
+        return len(self.__ensure_loaded())
+
+    def __getitem__(self, position):
+        return self.__ensure_loaded()[position]
+
+    def get(self, name):
+        """Returns the FontInfo with the given display name, or None."""
+        self.__ensure_loaded()
+        return self.__by_name.get(name)
+
+    def find(self, path, index=0):
+        """Returns the FontInfo of a font file (and face index), or None if it is not in the folder."""
+        self.__ensure_loaded()
+        return self.__by_path.get((os.path.normpath(path), index))
+
+    def info(self, path, index=0):
+        """
+        Returns the FontInfo of any font file: from the index if it is in the folder, otherwise
+        parsed once and memoized by path and modification time.
+        """
+        font = self.find(path, index)
+        if font is None:
+            key = (os.path.abspath(path), os.path.getmtime(path), index)
+            font = self.__external.get(key)
+            if font is None:
+                font = self.__external[key] = read_font_faces(path)[index]
+        return font
+
+    def position(self, font):
+        """Returns the position of a FontInfo in fonts, e.g. for a combo box."""
+        self.__ensure_loaded()
+        return self.__positions[(font.path, font.index)]
+
+
+def resolve_coverage(text, font, chain=()):
+    """
+    Checks every distinct character of text against the character map of font and assigns the
+    ones it lacks to the first font of chain that has them. Only set and range lookups are
+    involved, nothing is rasterized.
+
+    Args:
+        text: The text to be rendered.
+        font: FontInfo of the selected font.
+        chain: FontInfo of the fallback fonts, in order of preference.
+
+    Returns:
+        (fallback, missing): {char: FontInfo} for the characters taken from the chain, and the
+        sorted list of characters no font covers.
+    """
+    fallback = {}
+    missing = []
+    for char in sorted(set(text) - _IGNORED_CHARS):
+        if font.covers(char):
+            continue
+        for candidate in chain:
+            if candidate.covers(char):
+                fallback[char] = candidate
+                break
+        else:
+            missing.append(char)
+    return fallback, missing
+
+
+_default_registry = None
+
+
+def default_registry():
+    """Returns the process-wide registry of ttf_library/, created on first use."""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = FontRegistry()
+    return _default_registry
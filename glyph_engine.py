@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Glyph raster cache render engine.
+
+handright draws every character of a page onto a bitmap, then walks the bitmap pixel by pixel in
+Python to find and perturb strokes. Essays repeat the same few hundred characters thousands of
+times, so this engine rasterizes and splits each unique (font, size, character) into strokes only
+once, then places every occurrence by applying its perturbations as affine transforms of the
+cached stroke bitmaps inside Pillow.
+
+Layout comes from layout.layout_pages(), so page breaks and glyph positions are exactly those of
+handright. Perturbations follow the same distributions (a font size per character, an offset and
+a rotation per stroke), drawn from a different random sequence, so the result is statistically
+equivalent to the handright path rather than pixel-identical. Font size jitter is applied by
+scaling the glyph rasterized at the template's base size.
+"""
+import math
+import random
+
+from PIL import Image, ImageDraw
+# 复用 handright 的笔画 (4 邻域连通分量) 提取, 与常规渲染对笔画的定义一致
+from handright._core import _STROKE_END, _extract_strokes, _x_y
+
+from tools import LRUCache
+
+
+class _Stroke(object):
+    __slots__ = ("mask", "offset", "center")
+
+    def __init__(self, mask, offset, center):
+        self.mask = mask  # "L" 模式的笔画位图
+        self.offset = offset  # 位图左上角相对绘制原点的偏移
+        self.center = center  # 笔画外接框中心, 相对绘制原点
+
+
+def _stroke_nbytes(strokes):
+    return sum(s.mask.width * s.mask.height for s in strokes)
+
+
+# (字体路径, 字体索引, 字号, 字符) -> 笔画列表; 以笔画位图占用的内存计量
+_glyph_cache = LRUCache(max_bytes=256 << 20, sizeof=_stroke_nbytes)
+
+
+def rasterize_glyph(font, char):
+    """
+    Rasterizes char like handright's draft pass and splits it into strokes, cached per font and size.
+
+    Returns:
+        A list of _Stroke, empty for blank characters.
+    """
+    key = (getattr(font, "path", None), getattr(font, "index", 0), font.size, char)
+    strokes = _glyph_cache.get(key)
+    if strokes is not None:
+        return strokes
+    strokes = []
+    left, top, right, bottom = font.getbbox(char)
+    if right > left and bottom > top:
+        bitmap = Image.new("1", (right - left, bottom - top), 0)
+        ImageDraw.Draw(bitmap).text((-left, -top), char, fill=1, font=font)
+        bbox = bitmap.getbbox()
+        if bbox is not None:
+            strokes = _split_strokes(bitmap, bbox, (left, top))
+    _glyph_cache.put(key, strokes)
+    return strokes
+
+
+def _split_strokes(bitmap, bbox, origin):
+    strokes = []
+    points = []
+    for xy in _extract_strokes(bitmap.load(), bbox):
+        if xy != _STROKE_END:
+            points.append(_x_y(xy))
+            continue
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        min_x, min_y = min(xs), min(ys)
+        mask = Image.new("L", (max(xs) - min_x + 1, max(ys) - min_y + 1), 0)
+        pixels = mask.load()
+        for x, y in points:
+            pixels[x - min_x, y - min_y] = 255
+        offset = (origin[0] + min_x, origin[1] + min_y)
+        center = (origin[0] + (min_x + max(xs)) / 2, origin[1] + (min_y + max(ys)) / 2)
+        strokes.append(_Stroke(mask, offset, center))
+        points = []
+    return strokes
+
+
+class GlyphRenderer(object):
+    """
+    Picklable callable rendering a layout.PageLayout into a PIL image with cached glyph strokes.
+
+    Args:
+        template: The handright Template used for layout.
+        hashed_seed: hash() of the seed, computed in the parent process; None for a random seed.
+        fallback: Optional {char: font} for characters the template's font lacks, as passed to
+            layout.layout_pages().
+    """
+
+    def __init__(self, template, hashed_seed=None, fallback=None):
+        self.template = template
+        self.hashed_seed = hashed_seed
+        self.fallback = fallback or {}
+
+    def __call__(self, page):
+        rand = random.Random()
+        if self.hashed_seed is None:
+            rand.seed()
+        else:
+            rand.seed(a=self.hashed_seed + page.num)
+        canvas = self.template.get_background().copy()
+        mask = Image.new("L", canvas.size, 0)
+        self.draw_glyphs(mask, page.glyphs, rand)
+        canvas.paste(self.template.get_fill(), (0, 0), mask)
+        return canvas
+
+    def draw_glyphs(self, mask, glyphs, rand, origin=(0, 0)):
+        """
+        Draws perturbed glyphs as 255 onto an "L" mask whose top-left corner is at origin on the page.
+        """
+        tpl = self.template
+        font = tpl.get_font()
+        sigma_x = tpl.get_perturb_x_sigma()
+        sigma_y = tpl.get_perturb_y_sigma()
+        sigma_theta = tpl.get_perturb_theta_sigma()
+        for char, (x, y), size in glyphs:
+            glyph_font = self.fallback.get(char, font)
+            strokes = rasterize_glyph(glyph_font, char)
+            if not strokes or size == 0:
+                continue
+            scale = size / glyph_font.size
+            for stroke in strokes:
+                dx = rand.gauss(0, sigma_x) if sigma_x else 0
+                dy = rand.gauss(0, sigma_y) if sigma_y else 0
+                theta = rand.gauss(0, sigma_theta) if sigma_theta else 0
+                self._paste_stroke(mask, stroke, x - origin[0], y - origin[1], scale, dx, dy, theta)
+
+    @staticmethod
+    def _paste_stroke(mask, stroke, x, y, scale, dx, dy, theta):
+        # 正向变换 (与 handright._rotate 相同的旋转方向):
+        #   q = R(theta) * (scale * p - c) + c + (x + dx, y + dy),  c = scale * center
+        cos_t = math.cos(theta)
+        sin_t = math.sin(theta)
+        cx = scale * stroke.center[0]
+        cy = scale * stroke.center[1]
+        ox, oy = stroke.offset
+        w, h = stroke.mask.size
+
+        def forward(px, py):
+            rx = scale * (ox + px) - cx
+            ry = scale * (oy + py) - cy
+            return (rx * cos_t + ry * sin_t + cx + x + dx,
+                    -rx * sin_t + ry * cos_t + cy + y + dy)
+
+        corners = [forward(px, py) for px, py in ((0, 0), (w, 0), (0, h), (w, h))]
+        left = math.floor(min(c[0] for c in corners))
+        top = math.floor(min(c[1] for c in corners))
+        right = math.ceil(max(c[0] for c in corners))
+        bottom = math.ceil(max(c[1] for c in corners))
+        # 逆变换: 输出块内坐标 v -> 笔画位图坐标 u = A v + t
+        a, b = cos_t / scale, -sin_t / scale
+        d, e = sin_t / scale, cos_t / scale
+        qx = left - x - dx - cx
+        qy = top - y - dy - cy
+        tx = (cos_t * qx - sin_t * qy + cx) / scale - ox
+        ty = (sin_t * qx + cos_t * qy + cy) / scale - oy
+        patch = stroke.mask.transform((right - left, bottom - top), Image.Transform.AFFINE,
+                                      (a, b, tx, d, e, ty), resample=Image.Resampling.NEAREST)
+        mask.paste(255, (left, top), patch)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-resumable job queue for batch runs, stored in a SQLite file.
+
+Documents are enqueued with their text and output folder. The first task of every document
+paginates it (page -1); that task then adds one task per page. Workers lease a few tasks of one
+document at a time, render them and mark them done, so a run that crashes or is killed loses
+at most the pages that were being rendered: leases of dead workers expire and are handed out
+again, failed tasks are retried up to max_attempts times, and documents whose text and settings
+did not change keep their completed pages when the queue is enqueued again.
+"""
+import hashlib
+import os
+import socket
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+LAYOUT_TASK = -1  # 排版任务的页码, 完成后为每页添加任务
+
+_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+_ERROR_ACCESS_DENIED = 5
+_STILL_ACTIVE = 259
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    digest TEXT NOT NULL,
+    text TEXT NOT NULL,
+    output_dir TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    doc_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    page INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (doc_id, page)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, doc_id, page);
+"""
+
+
+def worker_id():
+    """Identifies the calling process as host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid):
+    if sys.platform == "win32":
+        return _win_pid_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # 进程存在但属于其他用户, 或平台不支持信号 0
+    return True
+
+
+def _win_pid_alive(pid):
+    # Windows 上 os.kill 会调用 TerminateProcess 结束目标进程, 因此通过进程句柄查询退出码
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # 拒绝访问说明进程存在但属于其他用户; 其余错误 (参数无效) 表示进程已不存在
+        return ctypes.get_last_error() == _ERROR_ACCESS_DENIED
+    try:
+        code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True  # 无法判断时视为存活, 等待租约自然过期
+        return code.value == _STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+class JobQueue(object):
+    """
+    A SQLite-backed queue of per-page render tasks, safe to share between processes.
+
+    Args:
+        path: Database file, created on demand.
+        lease_seconds: How long a leased task stays reserved without renewal before another
+            worker may take it over.
+        max_attempts: Leases per task before it is marked failed.
+    """
+
+    def __init__(self, path, lease_seconds=600.0, max_attempts=3):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.__db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA foreign_keys=ON")
+        self.__db.executescript(_SCHEMA)
+
+    def __getstate__(self):
+        # 传给进程池时只传配置, 连接在各进程中重新打开
+        return self.path, self.lease_seconds, self.max_attempts
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def close(self):
+        self.__db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE 立即取得写锁, 多个进程同时领取任务时不会领到同一任务
+        self.__db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.__db
+        except BaseException:
+            self.__db.execute("ROLLBACK")
+            raise
+        self.__db.execute("COMMIT")
+
+    @staticmethod
+    def digest(text, settings):
+        """Hashes a document's text with the render settings (any JSON-serializable description)."""
+        return hashlib.sha256(repr((text, settings)).encode("utf-8")).hexdigest()
+
+    def enqueue(self, name, text, output_dir, settings):
+        """
+        Adds a document, or keeps it unchanged when text, output folder and settings are the same
+        as when it was enqueued before (so its completed pages are not rendered again).
+
+        Returns:
+            True if the document was added or reset, False if it was already queued unchanged.
+        """
+        digest = self.digest(text, settings)
+        with self._transaction() as db:
+            row = db.execute("SELECT id, digest, output_dir FROM documents WHERE name = ?", (name,)).fetchone()
+            # 输出目录改变时已完成的页面不在新目录中, 文档需要重新渲染
+            if row is not None and row[1] == digest and row[2] == str(output_dir):
+                return False
+            if row is not None:
+                db.execute("DELETE FROM documents WHERE id = ?", (row[0],))
+            doc_id = db.execute("INSERT INTO documents (name, digest, text, output_dir) VALUES (?, ?, ?, ?)",
+                                (name, digest, text, str(output_dir))).lastrowid
+            db.execute("INSERT INTO tasks (doc_id, page) VALUES (?, ?)", (doc_id, LAYOUT_TASK))
+        return True
+
+    def reclaim(self):
+        """Returns tasks leased by processes of this host that no longer exist to the queue."""
+        host = socket.gethostname()
+        with self._transaction() as db:
+            for owner, in db.execute("SELECT DISTINCT owner FROM tasks WHERE status = 'leased'").fetchall():
+                owner_host, _, pid = owner.rpartition(":")
+                if owner_host == host and not _pid_alive(int(pid)):
+                    db.execute("UPDATE tasks SET status = 'pending', owner = NULL "
+                               "WHERE status = 'leased' AND owner = ?", (owner,))
+
+    def lease(self, owner, limit=1):
+        """
+        Reserves up to limit runnable tasks of one document for owner.
+
+        Returns:
+            (doc_id, name, text, output_dir, [page, ...]) or None if no task is runnable.
+        """
+        now = time.time()
+        runnable = ("(status = 'pending' OR (status = 'leased' AND lease_until < ?)) AND attempts < ?")
+        with self._transaction() as db:
+            first = db.execute(f"SELECT doc_id FROM tasks WHERE {runnable} ORDER BY doc_id, page LIMIT 1",
+                               (now, self.max_attempts)).fetchone()
+            if first is None:
+                return None
+            doc_id = first[0]
+            pages = [page for page, in db.execute(
+                f"SELECT page FROM tasks WHERE doc_id = ? AND {runnable} ORDER BY page LIMIT ?",
+                (doc_id, now, self.max_attempts, limit))]
+            db.executemany("UPDATE tasks SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                           "WHERE doc_id = ? AND page = ?",
+                           [(owner, now + self.lease_seconds, doc_id, page) for page in pages])
+            name, text, output_dir = db.execute("SELECT name, text, output_dir FROM documents WHERE id = ?",
+                                                (doc_id,)).fetchone()
+        return doc_id, name, text, output_dir, pages
+
+    def has_leased(self):
+        """Whether any task is still leased, i.e. more tasks may still become runnable (page tasks or retries)."""
+        return self.__db.execute("SELECT 1 FROM tasks WHERE status = 'leased' LIMIT 1").fetchone() is not None
+
+    def renew(self, doc_id, pages, owner):
+        """Extends the lease of tasks still held by owner."""
+        with self._transaction() as db:
+            db.executemany("UPDATE tasks SET lease_until = ? WHERE doc_id = ? AND page = ? AND owner = ? "
+                           "AND status = 'leased'",
+                           [(time.time() + self.lease_seconds, doc_id, page, owner) for page in pages])
+
+    def complete(self, doc_id, page, owner, page_count=None):
+        """Marks a task done; for the layout task, page_count adds the tasks of every page."""
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET status = 'done', owner = NULL, error = NULL "
+                       "WHERE doc_id = ? AND page = ? AND owner = ?", (doc_id, page, owner))
+            if page_count is not None:
+                db.executemany("INSERT OR IGNORE INTO tasks (doc_id, page) VALUES (?, ?)",
+                               [(doc_id, num) for num in range(page_count)])
+
+    def fail(self, doc_id, page, owner, error):
+        """Releases a task after an error; it is retried until max_attempts, then marked failed."""
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                       "owner = NULL, error = ? WHERE doc_id = ? AND page = ? AND owner = ?",
+                       (self.max_attempts, error, doc_id, page, owner))
+
+    def counts(self):
+        """Returns {status: task count}, where tasks that ran out of attempts count as failed."""
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        rows = self.__db.execute(
+            "SELECT CASE WHEN status IN ('pending', 'leased') AND attempts >= ? "
+            "AND (status = 'pending' OR lease_until < ?) THEN 'failed' ELSE status END, count(*) "
+            "FROM tasks WHERE page != ? GROUP BY 1", (self.max_attempts, time.time(), LAYOUT_TASK))
+        counts.update(dict(rows))
+        return counts
+
+    def failures(self):
+        """Returns (name, page, error) for every task that failed for good; page is -1 for layout."""
+        return self.__db.execute(
+            "SELECT d.name, t.page, t.error FROM tasks t JOIN documents d ON d.id = t.doc_id "
+            "WHERE t.status = 'failed' OR (t.status = 'pending' AND t.attempts >= ?) ORDER BY d.name, t.page",
+            (self.max_attempts,)).fetchall()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Layout-only pass over a handright Template.
+
+Reproduces handright's flow/grid layout (line breaks, start_chars/end_chars handling, page splits
+and the random jitter of positions and font sizes) from font metrics alone, without drawing.
+Because it consumes the layout random stream exactly like handright does, the resulting glyph
+positions and page boundaries are the same as those of handwrite() with the same seed.
+"""
+import random
+
+from handright import Feature, LayoutError
+from handright._util import Page
+
+_LF = "\n"
+_CR = "\r"
+_CRLF = "\r\n"
+
+
+def _gauss(rand, mu, sigma):
+    # 与 handright._util.gauss 一致: sigma 为 0 时不消耗随机数
+    if sigma == 0:
+        return mu
+    return rand.gauss(mu, sigma)
+
+
+class PageLayout(object):
+    """
+    The layout of one page.
+
+    Attributes:
+        num: Page index.
+        start: Index of the first character of the page in the preprocessed text.
+        end: Index one past the last character of the page.
+        glyphs: List of (char, (x, y), font_size) in drawing order, in pixels of the template.
+    """
+    __slots__ = ("num", "start", "end", "glyphs")
+
+    def __init__(self, num, start, end, glyphs):
+        self.num = num
+        self.start = start
+        self.end = end
+        self.glyphs = glyphs
+
+    def __repr__(self):
+        return f"PageLayout(num={self.num}, start={self.start}, end={self.end}, glyphs={len(self.glyphs)})"
+
+
+class _FontMetrics(object):
+    """
+    Caches font variants and glyph advances for every jittered font size of one layout pass.
+    Characters found in fallback ({char: font}) are measured with their fallback font.
+    """
+
+    def __init__(self, font, fallback=None):
+        self.font = font
+        self.fallback = fallback or {}
+        self.__variants = {(id(font), font.size): font}
+        self.__advances = {}
+
+    def variant(self, size, font=None):
+        font = font or self.font
+        key = (id(font), size)
+        variant = self.__variants.get(key)
+        if variant is None:
+            variant = font.font_variant(size=size)
+            self.__variants[key] = variant
+        return variant
+
+    def advance(self, char, size):
+        key = (char, size)
+        advance = self.__advances.get(key)
+        if advance is None:
+            left, top, right, bottom = self.variant(size, self.fallback.get(char)).getbbox(char)
+            advance = right - left
+            self.__advances[key] = advance
+        return advance
+
+
+def preprocess_text(text):
+    """Normalizes line endings the same way handright does; layout indices refer to this text."""
+    return text.replace(_CRLF, _LF).replace(_CR, _LF)
+
+
+def check_template(template):
+    """Raises handright.LayoutError for settings that make layout impossible, like handright."""
+    width, height = template.get_size()
+    font_size = template.get_font().size
+    line_spacing = template.get_line_spacing()
+    if height < template.get_top_margin() + line_spacing + template.get_bottom_margin():
+        raise LayoutError("for (height < top_margin + line_spacing + bottom_margin)")
+    if font_size > line_spacing:
+        raise LayoutError("for (font.size > line_spacing)")
+    if width < template.get_left_margin() + font_size + template.get_right_margin():
+        raise LayoutError("for (width < left_margin + font.size + right_margin)")
+    if template.get_word_spacing() <= -font_size // 2:
+        raise LayoutError("for (word_spacing <= -font.size // 2)")
+
+
+def layout_pages(text, template, seed=None, fallback=None):
+    """
+    Lays out text page by page.
+
+    Args:
+        text: The text passed to handwrite().
+        template: A single handright Template whose font is loaded.
+        seed: The seed passed to handwrite().
+        fallback: Optional {char: font} for characters the template's font lacks, fonts loaded at
+            the template's font size. Without it the layout is exactly handright's.
+
+    Yields:
+        A PageLayout per page, lazily.
+    """
+    text = preprocess_text(text)
+    rand = random.Random(x=seed)
+    metrics = _FontMetrics(template.get_font(), fallback)
+    num = 0
+    start = 0
+    while start < len(text):
+        glyphs = []
+        end = _layout_page(text, start, template, rand, metrics, glyphs)
+        yield PageLayout(num, start, end, glyphs)
+        num += 1
+        start = end
+
+
+def _layout_page(text, start, tpl, rand, metrics, glyphs):
+    # 与 handright._core._draw_page 的逻辑逐行对应
+    check_template(tpl)
+    width, height = tpl.get_size()
+    line_spacing = tpl.get_line_spacing()
+    font_size = tpl.get_font().size
+    start_chars = tpl.get_start_chars()
+    end_chars = tpl.get_end_chars()
+    right_edge = width - tpl.get_right_margin()
+    grid = Feature.GRID_LAYOUT in tpl.get_features()
+
+    y = tpl.get_top_margin() + line_spacing - font_size
+    while y <= height - tpl.get_bottom_margin() - font_size:
+        x = tpl.get_left_margin()
+        while True:
+            char = text[start]
+            if char == _LF:
+                start += 1
+                if start == len(text):
+                    return start
+                break
+            if x > right_edge - 2 * font_size and char in start_chars:
+                break
+            if x > right_edge - font_size and char not in end_chars:
+                break
+            if grid:
+                xy = (round(_gauss(rand, x, tpl.get_word_spacing_sigma())),
+                      round(_gauss(rand, y, tpl.get_line_spacing_sigma())))
+                size = _jittered_font_size(tpl, rand)
+                glyphs.append((char, xy, size))
+                x += tpl.get_word_spacing() + font_size
+            else:
+                xy = (round(x), round(_gauss(rand, y, tpl.get_line_spacing_sigma())))
+                size = _jittered_font_size(tpl, rand)
+                glyphs.append((char, xy, size))
+                x += _gauss(rand, tpl.get_word_spacing() + metrics.advance(char, size),
+                            tpl.get_word_spacing_sigma())
+            start += 1
+            if start == len(text):
+                return start
+        y += line_spacing
+    return start
+
+
+def _jittered_font_size(tpl, rand):
+    return max(round(_gauss(rand, tpl.get_font().size, tpl.get_font_size_sigma())), 0)
+
+
+def draw_draft(page, template, fallback=None):
+    """
+    Draws a PageLayout as the 1-bit page draft handright's renderer expects.
+
+    The draft is identical to the one handwrite() draws itself, so pages can be rendered
+    individually, out of order or on other machines while producing the same result.
+    Characters found in fallback ({char: font}, as passed to layout_pages) are drawn with their
+    fallback font.
+
+    Returns:
+        A handright page object with image and num attributes.
+    """
+    draft = Page("1", template.get_size(), 0, page.num)
+    draw = draft.draw()
+    metrics = _FontMetrics(template.get_font(), fallback)
+    for char, xy, size in page.glyphs:
+        draw.text(xy, char, fill=1, font=metrics.variant(size, metrics.fallback.get(char)))
+    return draft
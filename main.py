@@ -1,30 +1,178 @@
 # -*- coding: utf-8 -*-
+import math
 import os
+import threading
+import time
 import tomllib
 
-from PySide6.QtWidgets import QGraphicsPixmapItem, QGraphicsScene, QDialog, QFileDialog
+from PySide6.QtCore import QThread, QTimer, Qt, Signal
+from PySide6.QtGui import QImage, QPixmap
+from PySide6.QtWidgets import QApplication, QGraphicsPixmapItem, QGraphicsScene, QDialog, QFileDialog
 
-from QT_GUI.qt_gui import *
+from QT_GUI.qt_gui import Ui_Form
 from config import Config
-from core import handwrite_generator
 from tools import BasicTools
 
+# core (PIL, handright) 与字体扫描在窗口显示后由 StartupWorker 在后台加载
+DEFAULT_TEXT = (
+    "使用 PyQt5 编写的手写字生成器，旨在完成一些无用的手写作业任务"
+    "本项目提供了丰富的参数设置，以满足您在生成手写字时的个性化需求"
+)
+
+
+class StartupWorker(QThread):
+    """
+    Loads the render backend after the window is shown: imports core, scans the font folder and
+    renders the default preview, so that none of it delays the first paint.
+    """
+    backend_ready = Signal(object, object)  # (handwrite_generator, fonts.FontRegistry)
+    preview_ready = Signal(object)  # {页码: PIL 图片}
+
+    def __init__(self, parent=None):
+        super(StartupWorker, self).__init__(parent)
+        self.error = None
+
+    def run(self):
+        try:
+            from core import handwrite_generator
+            from fonts import default_registry
+            from render_cache import DEFAULT_CACHE_DIR, RenderCache
+
+            registry = default_registry()
+            generator = handwrite_generator()
+            generator.render_cache = RenderCache(DEFAULT_CACHE_DIR)
+            generator.template_params["default_background"] = (255, 255, 255, 255)
+            self.backend_ready.emit(generator, registry)
+            # 默认预览 (低分辨率, 与导出使用相同的排版和随机种子)
+            self.preview_ready.emit(generator.generate_preview(DEFAULT_TEXT))
+        except Exception as e:
+            self.error = e
+
+
+class ExportWorker(QThread):
+    """
+    Renders a document in a background thread and reports each page as soon as it is saved.
+
+    The thread renders with its own handwrite_generator and a snapshot of params, so the form can
+    change the window's generator while the export is running; only the render cache is shared.
+    """
+    page_ready = Signal(int, str)  # (页码, 图片路径)
+
+    def __init__(self, generator_engine, params, text, parent=None):
+        super(ExportWorker, self).__init__(parent)
+        self.generator_engine = generator_engine
+        self.params = dict(params)
+        self.text = text
+        self.cancel_event = threading.Event()
+        self.error = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        try:
+            import multiprocessing
+
+            from core import handwrite_generator
+            from numpy_engine import np
+
+            generator = handwrite_generator()
+            generator.render_cache = self.generator_engine.render_cache
+            generator.modify_template_params(**self.params)
+            # 使用进程池渲染, 取消时可以立即终止正在渲染的页面; x32 及以上按行带渲染以限制内存;
+            # 增量导出只重新渲染内容或参数变化的页面, 并清理多余的旧页面;
+            # 安装了 NumPy 时使用与 handright 逐像素一致但更快的 numpy 引擎
+            tiled = self.params["rate"] >= 32
+            engine = "numpy" if np is not None and not tiled else "handright"
+            # 界面进程中有多个线程, fork 出的工作进程可能继承被其他线程持有的锁而死锁, 因此使用 spawn;
+            # 增量导出没有需要重新渲染的页面时不会启动进程池
+            for i, save_path in generator.iter_images(
+                    self.text, workers=None, cancel_event=self.cancel_event,
+                    tiled=tiled, engine=engine, incremental=True,
+                    mp_context=multiprocessing.get_context("spawn")):
+                self.page_ready.emit(i, str(save_path))
+        except Exception as e:
+            self.error = e
+
 
 class Windows(QDialog, Ui_Form):
     def __init__(self):
         super(Windows, self).__init__()
         self.setupUi(self)
         self.basic_tools = BasicTools()
-        self.generator_engine = handwrite_generator()
-        self.params = self.generator_engine.template_params  # 获取默认参数
+        # 以下三项由 StartupWorker 在窗口显示后填充
+        self.font_registry = None
+        self.generator_engine = None
+        self.params = None
         self.preview_image_dict = {}
-
+        self.export_worker = None
+        self.pending_export = False  # 取消当前渲染后是否立即开始新的导出
+        self.page_count = None  # 当前导出由排版预处理得到的总页数
+        # 参数修改后延迟刷新低分辨率预览, 避免连续输入时重复渲染
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(300)
+        self.preview_edited = False  # 默认预览完成前用户是否已修改文本或参数
+
+        # 后端就绪前禁用依赖字体和渲染器的操作
+        for button in (self.pushButton_export, self.pushButton_save_config, self.pushButton_load_config):
+            button.setEnabled(False)
+        self.label_progress.setText("正在加载字体...")
+        self.startup_worker = StartupWorker(self)
+        self.startup_worker.backend_ready.connect(self.on_backend_ready)
+        self.startup_worker.preview_ready.connect(self.on_default_preview)
+        self.startup_worker.finished.connect(self.on_startup_finished)
+
+    def showEvent(self, event):
+        super(Windows, self).showEvent(event)
+        if not self.startup_worker.isRunning() and self.generator_engine is None:
+            self.startup_worker.start()
+
+    def on_backend_ready(self, generator_engine, font_registry):
+        self.generator_engine = generator_engine
+        self.font_registry = font_registry
+        self.params = generator_engine.template_params  # 获取默认参数
         # 设置默认启动项
         self.set_default()
         self.connect_signal()
+        for button in (self.pushButton_export, self.pushButton_save_config, self.pushButton_load_config):
+            button.setEnabled(True)
+        self.label_progress.setText("")
+
+    def on_default_preview(self, image_dict):
+        # 用户已开始编辑时由 refresh_preview 显示新的预览
+        if not self.preview_edited:
+            self.show_pages(image_dict)
+
+    def on_startup_finished(self):
+        if self.startup_worker.error is not None:
+            print(f"加载失败: {self.startup_worker.error}")
+            self.label_progress.setText("加载失败")
+
+    @staticmethod
+    def pil_to_qimage(im):
+        """
+        Wraps the pixel buffer of a PIL image as a QImage without PNG encoding or decoding.
 
-    def img_show_func(self, img_path):
-        frame = QImage(str(img_path), "PNG")
+        The returned QImage references the buffer, so the caller must keep the image alive
+        (or convert it) while it is used.
+        """
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        buffer = im.tobytes("raw", "RGBA")
+        frame = QImage(buffer, im.width, im.height, im.width * 4, QImage.Format.Format_RGBA8888)
+        frame.pil_buffer = buffer  # 保持缓冲区存活
+        return frame
+
+    def img_show_func(self, img):
+        # img 为图片路径 (导出结果) 或内存中的 PIL 图片 (预览)
+        if isinstance(img, (str, os.PathLike)):
+            frame = QImage(str(img))
+        else:
+            frame = self.pil_to_qimage(img)
         frame = frame.scaled(667, 945, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
         pix = QPixmap.fromImage(frame)
         item = QGraphicsPixmapItem(pix)
@@ -34,23 +182,72 @@ class Windows(QDialog, Ui_Form):
         self.img_preview.horizontalScrollBar().setValue(1)  # 设置滚动条初始位置
         self.img_preview.verticalScrollBar().setValue(1)  # 设置滚动条初始位置
 
+    def show_pages(self, image_dict):
+        # 刷新页码列表, 尽量保持当前查看的页码
+        current = max(self.page_number.currentIndex(), 0)
+        self.preview_image_dict = image_dict
+        self.page_number.blockSignals(True)
+        self.page_number.clear()
+        self.page_number.addItems([str(i) for i in image_dict])
+        self.page_number.setCurrentIndex(min(current, len(image_dict) - 1))
+        self.page_number.blockSignals(False)
+        self.page_number_change()
+
+    def schedule_preview(self):
+        self.preview_edited = True
+        self.preview_timer.start()
+
+    def refresh_preview(self):
+        # 导出进行中时由导出结果填充页码列表
+        if self.export_worker is not None and self.export_worker.isRunning():
+            return
+        try:
+            self.get_info_from_form()
+        except ValueError:
+            return  # 表单尚未填写完整
+        preview_rate = max(1, math.ceil(self.img_preview.devicePixelRatioF()))
+        try:
+            self.show_pages(self.generator_engine.generate_preview(
+                self.get_text_from_textedit_main(), preview_rate=preview_rate))
+        except Exception as e:
+            print(f"预览失败: {e}")
+
     def page_number_change(self):
         if self.page_number.currentText() != "":
-            self.img_show_func(self.preview_image_dict[int(self.page_number.currentText())])
+            image = self.preview_image_dict.get(int(self.page_number.currentText()))
+            if image is not None:
+                self.img_show_func(image)
+            else:
+                self.img_preview.setScene(QGraphicsScene())  # 该页尚未渲染完成
 
     def connect_signal(self):
         self.page_number.currentIndexChanged.connect(self.page_number_change)
         self.pushButton_export.clicked.connect(self.export)
+        self.pushButton_cancel.clicked.connect(self.cancel_export)
         self.pushButton_save_config.clicked.connect(self.save_config)
         self.pushButton_load_config.clicked.connect(self.load_config)
 
+        # 任意参数变化后刷新预览
+        self.preview_timer.timeout.connect(self.refresh_preview)
+        self.textEdit_main.textChanged.connect(self.schedule_preview)
+        for line_edit in (self.lineEdit_width, self.lineEdit_height, self.lineEdit_font_size,
+                          self.lineEdit_line_spacing, self.lineEdit_char_distance,
+                          self.lineEdit_margin_top, self.lineEdit_margin_bottom,
+                          self.lineEdit_margin_left, self.lineEdit_margin_right,
+                          self.lineEdit_line_spacing_sigma, self.lineEdit_font_size_sigma,
+                          self.lineEdit_word_spacing_sigma, self.lineEdit_perturb_x_sigma,
+                          self.lineEdit_perturb_y_sigma, self.lineEdit_perturb_theta_sigma):
+            line_edit.editingFinished.connect(self.schedule_preview)
+        for combo_box in (self.ttf_selector, self.comboBox_char_color, self.comboBox_background_color):
+            combo_box.currentIndexChanged.connect(self.schedule_preview)
+
     def set_default(self):
         # 设置宽度高度
         self.lineEdit_width.setText(str(self.params["default_paper_x"]))
         self.lineEdit_height.setText(str(self.params["default_paper_y"]))
 
         # 设置默认字体和候选字体
-        self.ttf_selector.addItems(self.basic_tools.get_ttf_file_path()[0])
+        self.ttf_selector.addItems(self.font_registry.names)
         self.ttf_selector.setCurrentIndex(0)
 
         # 设置字体大小，行距，字距
@@ -79,27 +276,20 @@ class Windows(QDialog, Ui_Form):
         self.lineEdit_perturb_theta_sigma.setText(str(self.params["default_perturb_theta_sigma"]))
 
         # 设置默认文本
-        default_text = (
-            "使用 PyQt5 编写的手写字生成器，旨在完成一些无用的手写作业任务"
-            "本项目提供了丰富的参数设置，以满足您在生成手写字时的个性化需求"
-        )
-        self.textEdit_main.setPlainText(default_text)
+        self.textEdit_main.setPlainText(DEFAULT_TEXT)
 
         # 设置默认倍率
         self.comboBox_resolution.addItems(self.basic_tools.default_rate_dict.keys())
         self.comboBox_resolution.setCurrentIndex(2)
-
-        # 设置默认预览
-        self.generator_engine.modify_template_params(default_background=(255, 255, 255, 255))
-        preview_image_dict = self.generator_engine.generate_image(default_text)
-        self.img_show_func(preview_image_dict[0])
-        self.page_number.addItems([str(i) for i in preview_image_dict])  # 设置page列表
+        # 默认预览由 StartupWorker 在后台渲染
 
     # 读取填写信息
     def get_info_from_form(self):
         self.params["default_paper_x"] = int(float(self.lineEdit_width.text()))
         self.params["default_paper_y"] = int(float(self.lineEdit_height.text()))
-        self.params["default_font"] = self.basic_tools.get_ttf_file_path()[1][self.ttf_selector.currentIndex()]
+        font = self.font_registry[self.ttf_selector.currentIndex()]
+        self.params["default_font"] = font.path
+        self.params["default_font_index"] = font.index
         self.params["default_font_size"] = int(float(self.lineEdit_font_size.text()))
         self.params["default_line_spacing"] = int(float(self.lineEdit_line_spacing.text()))
         self.params["default_word_spacing"] = int(float(self.lineEdit_char_distance.text()))
@@ -125,7 +315,9 @@ class Windows(QDialog, Ui_Form):
         config = Config()
         config.width = int(float(self.lineEdit_width.text()))
         config.height = int(float(self.lineEdit_height.text()))
-        config.ttf_selector = self.basic_tools.get_ttf_file_path()[1][self.ttf_selector.currentIndex()]
+        font = self.font_registry[self.ttf_selector.currentIndex()]
+        config.ttf_selector = font.path
+        config.ttf_index = font.index
         config.font_size = int(float(self.lineEdit_font_size.text()))
         config.line_spacing = int(float(self.lineEdit_line_spacing.text()))
         config.char_distance = int(float(self.lineEdit_char_distance.text()))
@@ -168,10 +360,9 @@ class Windows(QDialog, Ui_Form):
                 self.lineEdit_height.setText(str(config.height))
 
             if config.ttf_selector is not None:
-                for i, ttf in enumerate(self.basic_tools.get_ttf_file_path()[1]):
-                    if ttf == config.ttf_selector:
-                        self.ttf_selector.setCurrentIndex(i)
-                        break
+                font = self.font_registry.find(config.ttf_selector, config.ttf_index or 0)
+                if font is not None:
+                    self.ttf_selector.setCurrentIndex(self.font_registry.position(font))
 
             if config.font_size is not None:
                 self.lineEdit_font_size.setText(str(config.font_size))
@@ -240,32 +431,105 @@ class Windows(QDialog, Ui_Form):
 
     # 导出
     def export(self):
-        folder_path = "outputs"
-        if os.path.exists(folder_path):
-            # 遍历目录中的所有文件和子目录
-            for filename in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, filename)
-                try:
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    print(f"无法删除文件 '{file_path}': {e}")
-        else:
-            print(f"目录 '{folder_path}' 不存在。")
+        if self.export_worker is not None and self.export_worker.isRunning():
+            # 取消正在进行的渲染, 待其结束后立即开始新的导出
+            self.pending_export = True
+            self.export_worker.cancel()
+            return
         self.page_number.clear()
+        self.preview_image_dict = {}
         self.get_info_from_form()
+        text = self.get_text_from_textedit_main()
+        # 先只排版得到总页数, 页码列表立即可用, 各页渲染完成后再显示
         self.generator_engine.modify_template_params(**self.params)
-        self.generator_engine.generate_template()
-        self.preview_image_dict = self.generator_engine.generate_image(
-            self.get_text_from_textedit_main())
-        self.img_show_func(self.preview_image_dict[0])
-        self.page_number.addItems([str(i) for i in self.preview_image_dict])
+        try:
+            self.page_count = len(self.generator_engine.paginate(text))
+        except Exception as e:
+            print(f"排版失败: {e}")
+            self.page_count = None
+        if self.page_count:
+            self.page_number.blockSignals(True)
+            self.page_number.addItems([str(i) for i in range(self.page_count)])
+            self.page_number.blockSignals(False)
+        self.export_worker = ExportWorker(self.generator_engine, self.params, text, self)
+        self.export_worker.page_ready.connect(self.on_page_ready)
+        self.export_worker.finished.connect(self.on_export_finished)
+        self.pushButton_cancel.setEnabled(True)
+        progress = f"渲染中, 共 {self.page_count} 页" if self.page_count else "渲染中..."
+        missing = self.generator_engine.check_coverage(text)[1]
+        if missing:
+            progress += f" (所有字体都缺少: {''.join(missing[:10])}{'...' if len(missing) > 10 else ''})"
+        self.label_progress.setText(progress)
+        self.export_worker.start()
+
+    def cancel_export(self):
+        if self.export_worker is not None and self.export_worker.isRunning():
+            self.pending_export = False
+            self.export_worker.cancel()
+            self.label_progress.setText("正在取消...")
+
+    def on_page_ready(self, page_index, img_path):
+        self.preview_image_dict[page_index] = img_path
+        if page_index >= self.page_number.count():
+            self.page_number.addItem(str(page_index))  # 添加第一页时会触发预览
+        elif page_index == self.page_number.currentIndex():
+            self.page_number_change()
+        if self.page_count:
+            self.label_progress.setText(f"已完成 {len(self.preview_image_dict)}/{self.page_count} 页")
+        else:
+            self.label_progress.setText(f"已完成 {len(self.preview_image_dict)} 页")
+
+    def on_export_finished(self):
+        self.pushButton_cancel.setEnabled(False)
+        if self.export_worker.error is not None:
+            print(f"导出失败: {self.export_worker.error}")
+            self.label_progress.setText("导出失败")
+        elif self.export_worker.is_cancelled():
+            self.label_progress.setText("已取消")
+        else:
+            self.label_progress.setText(f"完成, 共 {len(self.preview_image_dict)} 页")
+        if self.pending_export:
+            self.pending_export = False
+            self.export()
+
+    def closeEvent(self, event):
+        if self.export_worker is not None and self.export_worker.isRunning():
+            self.export_worker.cancel()
+            self.export_worker.wait()
+        self.startup_worker.wait()
+        super(Windows, self).closeEvent(event)
+
+
+def startup_probe(app, window):
+    """
+    Prints the wall-clock times (time.time()) at which the window was first shown, the backend
+    became ready and the default preview was displayed as one JSON line, then quits. Used by
+    benchmark.py --startup-runs to measure cold starts.
+    """
+    import json
+
+    marks = {}
+
+    def mark(name):
+        marks[name] = time.time()
+        if name == "preview" or window.startup_worker.error is not None:
+            print(json.dumps(marks), flush=True)
+            app.quit()
+
+    QTimer.singleShot(0, lambda: mark("shown"))  # 首次进入事件循环时窗口已显示
+    window.startup_worker.backend_ready.connect(lambda *_: mark("backend"))
+    window.startup_worker.preview_ready.connect(lambda *_: QTimer.singleShot(0, lambda: mark("preview")))
+    window.startup_worker.finished.connect(lambda: window.startup_worker.error is not None and mark("error"))
 
 
 if __name__ == "__main__":
+    import multiprocessing
     import sys
 
+    multiprocessing.freeze_support()  # 打包后的可执行文件使用多进程渲染时需要
     app = QApplication(sys.argv)
     window = Windows()
     window.show()
+    if "--startup-probe" in sys.argv:
+        startup_probe(app, window)
     sys.exit(app.exec_())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy stroke perturbation render engine.
+
+handright finds the strokes of a page draft with a depth-first search over every ink pixel and
+then moves the pixels one by one, all in Python, so its cost grows with rate². This engine does
+both steps as array operations over the whole page: ink pixels are grouped into horizontal runs,
+runs touching in adjacent rows are merged into strokes (4-connected components, the same stroke
+definition as handright), and each stroke's rotation and offset is applied to all of its pixels at
+once.
+
+Strokes are numbered in the order handright discovers them (by their first ink pixel in row-major
+order) and draw their offsets and rotation from the same random stream, and the arithmetic
+matches handright's, so the output is pixel-identical to the handright engine. Requires NumPy.
+"""
+import math
+import random
+
+from PIL import Image
+from handright._util import gauss
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 为可选依赖
+    np = None
+
+
+def _label_runs(ink):
+    """
+    Splits a boolean ink array into row runs and labels 4-connected runs with a common stroke id.
+
+    Returns:
+        (rows, starts, ends, labels) per run, in row-major order; ends are exclusive and labels are
+        the index of the first run of each stroke, so they increase in handright's discovery order.
+    """
+    height, width = ink.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = ink
+    # 每行中行程的起点 (+1) 与终点 (-1) 交替出现
+    rows, columns = np.nonzero(np.diff(padded, axis=1))
+    rows, starts, ends = rows[0::2], columns[0::2], columns[1::2]
+    count = len(rows)
+
+    # 相邻两行中列区间有交集的行程属于同一笔画; 行程按 (行, 起点) 排序, 用二分查找得到上一行中与之相交的行程
+    stride = width + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    first = np.searchsorted(end_keys, (rows - 1) * stride + starts, side="right")
+    last = np.searchsorted(start_keys, (rows - 1) * stride + ends, side="left")
+    spans = np.maximum(last - first, 0)
+    below = np.repeat(np.arange(count), spans)
+    above = np.repeat(first, spans) + (np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans))
+
+    # 并查集: 每轮把较大的根挂到较小的根上, 再做指针跳跃直到每个行程直接指向根
+    labels = np.arange(count)
+    while len(below):
+        a, b = labels[below], labels[above]
+        if np.array_equal(a, b):
+            break
+        np.minimum.at(labels, np.maximum(a, b), np.minimum(a, b))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return rows, starts, ends, labels
+
+
+class NumpyRenderer(object):
+    """
+    Picklable callable rendering a handright page draft into a PIL image with NumPy.
+
+    Args:
+        template: The handright Template used for layout.
+        hashed_seed: hash() of the seed passed to handwrite(), computed in the parent process.
+    """
+
+    def __init__(self, template, hashed_seed=None):
+        if np is None:
+            raise RuntimeError("the numpy render engine requires NumPy (pip install numpy)")
+        self.background = template.get_background()
+        self.size = template.get_size()
+        self.fill = template.get_fill()
+        self.perturb_sigmas = (template.get_perturb_x_sigma(),
+                               template.get_perturb_y_sigma(),
+                               template.get_perturb_theta_sigma())
+        self.hashed_seed = hashed_seed
+
+    def __call__(self, page):
+        rand = random.Random()
+        if self.hashed_seed is None:
+            rand.seed()
+        else:
+            rand.seed(a=self.hashed_seed + page.num)
+        bbox = page.image.getbbox()
+        if bbox is None:
+            return self.background.copy()
+        x, y = self.perturb(np.asarray(page.image.crop(bbox)), bbox[:2], rand)
+        canvas = np.array(self.background)
+        canvas[y, x] = self.fill
+        return Image.fromarray(canvas, self.background.mode)
+
+    def perturb(self, ink, origin, rand):
+        """
+        Perturbs every stroke of a boolean ink array located at origin on the page.
+
+        Returns:
+            (x, y) arrays of the page pixels the perturbed strokes land on.
+        """
+        rows, starts, ends, labels = _label_runs(ink)
+        strokes, stroke_of_run = np.unique(labels, return_inverse=True)
+
+        # 笔画外接框中心, 与 handright 相同地取 ((min_x + max_x) / 2, (min_y + max_y) / 2)
+        left, upper = origin
+        count = len(strokes)
+        min_x = np.full(count, np.iinfo(np.int64).max)
+        max_x = np.zeros(count, dtype=np.int64)
+        min_y = np.full(count, np.iinfo(np.int64).max)
+        max_y = np.zeros(count, dtype=np.int64)
+        np.minimum.at(min_x, stroke_of_run, starts)
+        np.maximum.at(max_x, stroke_of_run, ends - 1)
+        np.minimum.at(min_y, stroke_of_run, rows)
+        np.maximum.at(max_y, stroke_of_run, rows)
+        center_x = (min_x + max_x + 2 * left) / 2
+        center_y = (min_y + max_y + 2 * upper) / 2
+
+        # 按 handright 发现笔画的顺序为每个笔画抽取 (dx, dy, theta); 三角函数用 math 计算, 与 handright 逐位一致
+        x_sigma, y_sigma, theta_sigma = self.perturb_sigmas
+        offsets = np.empty((count, 5), dtype=np.float64)
+        for i in range(count):
+            dx, dy, theta = gauss(rand, 0, x_sigma), gauss(rand, 0, y_sigma), gauss(rand, 0, theta_sigma)
+            offsets[i] = dx, dy, theta, math.cos(theta), math.sin(theta)
+
+        lengths = ends - starts
+        run_of_pixel = np.repeat(np.arange(len(rows)), lengths)
+        x = (np.repeat(starts, lengths) + np.arange(lengths.sum())
+             - np.repeat(np.cumsum(lengths) - lengths, lengths) + left)
+        y = rows[run_of_pixel] + upper
+        stroke = stroke_of_run[run_of_pixel]
+        dx, dy, theta, cos, sin = offsets[stroke].T
+        cx, cy = center_x[stroke], center_y[stroke]
+        rotated = theta != 0
+        new_x = np.where(rotated, (x - cx) * cos + (y - cy) * sin + cx, x)
+        new_y = np.where(rotated, (y - cy) * cos - (x - cx) * sin + cy, y)
+        # np.rint 与 round() 一样四舍六入五成双
+        new_x = np.rint(new_x + dx).astype(np.int64)
+        new_y = np.rint(new_y + dy).astype(np.int64)
+
+        width, height = self.size
+        inside = (new_x >= 0) & (new_x < width) & (new_y >= 0) & (new_y < height)
+        return new_x[inside], new_y[inside]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage and per-page timing of a render.
+
+A RenderStats collects wall time and resident memory deltas for the stages of one export (font
+loading, template construction, layout, rendering, encoding) and for every page. It is filled
+by handwrite_generator as it renders, returned with the page dict as RenderResult.stats and
+logged as structured JSON records. profiled() additionally runs a block under cProfile and dumps
+the result for pstats, snakeviz or flameprof.
+"""
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("handwrite.stats")
+
+
+def current_rss_mb():
+    """Returns the resident set size of this process in MiB, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1 << 20)
+    except (OSError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MiB, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KiB 为单位, macOS 以字节为单位
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+class RenderStats(object):
+    """
+    Wall time and memory deltas per stage and per page of one render. Thread-safe, since pages
+    are encoded on writer threads.
+
+    With several worker processes only the parent is observed: each page then reports the time
+    until it arrived as "render".
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+        self.stages = {}  # 阶段 -> {"calls", "seconds", "rss_delta_mb"}
+        self.pages = {}  # 页码 -> {阶段 + "_s": 秒, "rss_mb": 完成该阶段后的常驻内存}
+
+    def record(self, stage, seconds, rss_delta=None, page=None, rss=None):
+        with self.__lock:
+            total = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "rss_delta_mb": 0.0})
+            total["calls"] += 1
+            total["seconds"] += seconds
+            if rss_delta is not None:
+                total["rss_delta_mb"] += rss_delta
+            if page is not None:
+                entry = self.pages.setdefault(page, {})
+                entry[stage + "_s"] = entry.get(stage + "_s", 0.0) + seconds
+                if rss is not None:
+                    entry["rss_mb"] = round(rss, 1)
+
+    @contextmanager
+    def stage(self, name, page=None):
+        """Times the enclosed block as one call of stage name, attributed to page if given."""
+        rss = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            after = current_rss_mb()
+            self.record(name, seconds, None if rss is None else after - rss, page, after)
+
+    def call(self, name, page, func, *args):
+        with self.stage(name, page):
+            return func(*args)
+
+    def timed(self, iterable, name, page_of=lambda item: getattr(item, "num", None)):
+        """Wraps an iterable, timing the production of every item as stage name."""
+        iterator = iter(iterable)
+        while True:
+            rss = current_rss_mb()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            after = current_rss_mb()
+            self.record(name, time.perf_counter() - start, None if rss is None else after - rss, page_of(item), after)
+            yield item
+
+    def as_dict(self):
+        with self.__lock:
+            return {
+                "total_s": round(time.perf_counter() - self.__start, 4),
+                "peak_rss_mb": None if resource is None else round(peak_rss_mb(), 1),
+                "stages": {name: {"calls": s["calls"], "seconds": round(s["seconds"], 4),
+                                  "rss_delta_mb": round(s["rss_delta_mb"], 1)}
+                           for name, s in self.stages.items()},
+                "pages": [dict(page=num, **{k: round(v, 4) for k, v in entry.items()})
+                          for num, entry in sorted(self.pages.items())],
+            }
+
+    def log(self, **context):
+        """Emits one JSON record per page (DEBUG) and a summary record (INFO) on the handwrite.stats logger."""
+        stats = self.as_dict()
+        for page in stats["pages"]:
+            logger.debug(json.dumps(dict(context, event="page", **page), ensure_ascii=False))
+        logger.info(json.dumps(dict(context, event="render", total_s=stats["total_s"], peak_rss_mb=stats["peak_rss_mb"],
+                                    pages=len(stats["pages"]), stages=stats["stages"]), ensure_ascii=False))
+
+
+class RenderResult(dict):
+    """The {page: path or image} dict of a render, with the RenderStats.as_dict() of that render as stats."""
+
+    def __init__(self, pages=(), stats=None):
+        super(RenderResult, self).__init__(pages)
+        self.stats = stats
+
+
+@contextmanager
+def profiled(path):
+    """
+    Runs the enclosed block under cProfile and dumps the statistics to path (a pstats file,
+    viewable with snakeviz or convertible to a flame graph with flameprof). Does nothing if path is None.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(path))
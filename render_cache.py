@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed on-disk cache of rendered documents.
+
+Rendering is deterministic for a given text, set of template parameters, font file and seed, so a
+document rendered once can be served from disk afterwards. Entries are keyed by a SHA-256 over all
+of these (the font by its contents, not its path), stored one folder per document and evicted
+least-recently-used first once the cache grows beyond its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "handwrite")
+
+# 输出路径不影响渲染结果, 不参与缓存键
+_IGNORED_PARAMS = ("default_img_output_path",)
+_ENTRY_INFO = "entry.json"
+
+# (字体路径, 修改时间) -> 字体文件内容的 SHA-256
+_font_digests = {}
+
+
+def font_digest(font_path):
+    """Returns the SHA-256 of a font file's contents, memoized per path and modification time."""
+    key = (font_path, os.path.getmtime(font_path))
+    digest = _font_digests.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(font_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = _font_digests[key] = sha.hexdigest()
+    return digest
+
+
+class RenderCache(object):
+    """
+    A size-limited, least-recently-used cache of rendered pages on disk.
+
+    Args:
+        root: Cache folder, created on demand.
+        max_bytes: Total size limit of all entries; older entries are evicted beyond it.
+    """
+
+    def __init__(self, root, max_bytes=2 << 30):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        # 传给进程池时只传配置, 锁在各进程中重新创建
+        return self.root, self.max_bytes
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def make_key(text, params, seed, engine="handright", image_format="png", fallback=None, compress_level=6):
+        """
+        Hashes everything that determines the rendered pages into a hex key. fallback maps the
+        characters drawn with fallback fonts to (font path, face index); compress_level changes
+        the files even though the pixels are the same.
+        """
+        relevant = {k: v for k, v in params.items() if k not in _IGNORED_PARAMS}
+        relevant["default_font"] = font_digest(params["default_font"])
+        relevant["fallback"] = sorted((char, font_digest(path), index)
+                                      for char, (path, index) in (fallback or {}).items())
+        payload = json.dumps({
+            "text": text,
+            "params": sorted((k, repr(v)) for k, v in relevant.items()),
+            "seed": [str(seed), hash(seed)],
+            "engine": engine,
+            "format": image_format,
+            "compress_level": compress_level,
+        }, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a rendered document.
+
+        Returns:
+            The list of page files in page order, or None on a miss.
+        """
+        entry = self.root.joinpath(key)
+        try:
+            with open(entry.joinpath(_ENTRY_INFO), encoding="utf-8") as f:
+                info = json.load(f)
+            pages, suffix = info["pages"], info.get("suffix", ".png")
+        except (OSError, ValueError, KeyError):
+            return None
+        paths = [entry.joinpath(f"{i}{suffix}") for i in range(pages)]
+        if not all(p.exists() for p in paths):
+            return None
+        os.utime(entry)  # 记录最近使用时间
+        return paths
+
+    def put(self, key, page_paths):
+        """Copies the rendered pages (in page order) into the cache and evicts old entries if needed."""
+        entry = self.root.joinpath(key)
+        if entry.exists():
+            return
+        staging = self.root.joinpath(f".{key}.{os.getpid()}.{threading.get_ident()}")
+        staging.mkdir(parents=True, exist_ok=True)
+        suffix = Path(page_paths[0]).suffix if page_paths else ".png"
+        for i, path in enumerate(page_paths):
+            shutil.copyfile(path, staging.joinpath(f"{i}{suffix}"))
+        with open(staging.joinpath(_ENTRY_INFO), "w", encoding="utf-8") as f:
+            json.dump({"pages": len(page_paths), "suffix": suffix, "created": time.time()}, f)
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            # 其他进程已写入同一条目
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Removes least-recently-used entries until the cache fits in max_bytes."""
+        with self.__lock:
+            entries = []
+            total = 0
+            for entry in self.root.iterdir():
+                if not entry.is_dir() or entry.name.startswith("."):
+                    continue
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+                total += size
+            entries.sort()
+            for _, size, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Local rendering service.
+
+An asyncio HTTP server in front of a pool of warm worker processes. Each worker imports core,
+builds the default template and loads every registered font once at start-up, so a request
+only pays for layout and rendering. Pages are streamed back as newline-delimited JSON while the
+document is still being rendered. Never imports PySide6.
+
+Endpoints:
+    POST /render  {"text": "...", "config": {...} or "<TOML>", "format": "png", "engine": "handright",
+                   "compress_level": 6, "timeout": 60}
+                  -> application/x-ndjson, one {"page": n, "format": ..., "data": <base64>} line per page,
+                     then {"done": true, "pages": n, "seconds": s} or {"error": "..."}
+    GET  /health  -> {"workers": n, "idle": n, "queued": n}
+
+Every request renders on a single worker. Requests wait for a free worker up to --max-queue,
+each client address may have at most --max-per-client requests in flight, and a request that
+exceeds its timeout is cancelled (its worker is restarted if it does not stop within a grace period).
+
+Usage:
+    python service.py --workers 4 --port 8765
+    curl -N localhost:8765/render -d '{"text": "你好", "config": {"resolution": 2}}'
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("handwrite.service")
+
+_CANCEL_GRACE = 2.0  # 取消后等待工作进程停止的秒数, 超时则重启该进程
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+            429: "Too Many Requests", 503: "Service Unavailable"}
+
+
+def _service_worker(conn):
+    # 工作进程: 预加载默认模板与全部字体, 然后逐个处理 (文本, 配置, 格式) 任务
+    from config import Config
+    from core import handwrite_generator, load_font
+    from fonts import default_registry
+    from writers import PageFormat
+
+    generator = handwrite_generator()
+    defaults = dict(generator.template_params)
+    generator.generate_template()
+    for font in default_registry():
+        load_font(font.path, size=defaults["default_font_size"] * defaults["rate"], index=font.index)
+    conn.send(("ready",))
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        if not isinstance(job, tuple):
+            continue  # 最后一页发出后才到达的 "cancel", 对应的任务已经结束
+        start = time.perf_counter()
+        pages = 0
+        try:
+            text, config, image_format, compress_level, engine = job
+            generator.template_params = dict(defaults)
+            generator.apply_config(Config.from_dict(config))
+            page_format = PageFormat(image_format, compress_level)
+            cancelled = False
+            for num, im in generator.iter_images(text, save=False, engine=engine):
+                buffer = io.BytesIO()
+                page_format.save(im, buffer)
+                conn.send(("page", num, buffer.getvalue()))
+                pages += 1
+                # 页与页之间检查取消请求
+                if conn.poll() and conn.recv() == "cancel":
+                    cancelled = True
+                    break
+            conn.send(("cancelled",) if cancelled else ("done", pages, time.perf_counter() - start))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _WarmWorker(object):
+    """A worker process and the parent's end of its pipe."""
+
+    def __init__(self, context, executor):
+        self.context = context
+        self.executor = executor
+        self.process = None
+        self.conn = None
+        self.pending = None  # 尚未取回结果的 conn.recv(), 超时后保留以免丢失消息
+
+    def start(self):
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(target=_service_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.pending = None
+
+    async def recv(self, timeout=None):
+        """Returns the next message from the worker, raising asyncio.TimeoutError after timeout seconds."""
+        if self.pending is None:
+            self.pending = asyncio.get_running_loop().run_in_executor(self.executor, self.conn.recv)
+        done, _ = await asyncio.wait({self.pending}, timeout=timeout)
+        if not done:
+            raise asyncio.TimeoutError
+        future, self.pending = self.pending, None
+        return future.result()
+
+    def send(self, message):
+        self.conn.send(message)
+
+    def _discard_pending(self):
+        # 被终止的进程留下的 recv 会以 EOFError/ConnectionResetError 结束, 取回异常以免 asyncio 报告未处理的异常
+        if self.pending is not None:
+            self.pending.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self.pending = None
+
+    def stop(self):
+        self._discard_pending()
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+    async def restart(self):
+        self._discard_pending()
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.start()
+        await self.recv()  # ("ready",)
+
+
+class RenderService(object):
+    """
+    Serves /render and /health on top of a pool of warm worker processes.
+
+    Args:
+        workers: Number of worker processes, i.e. documents rendered concurrently.
+        max_queue: Requests allowed to wait for a free worker; more are rejected with 503.
+        max_per_client: Requests in flight per client address; more are rejected with 429.
+        timeout: Upper bound, in seconds, on a request's total time including waiting for a worker.
+        max_body: Largest accepted request body in bytes.
+    """
+
+    def __init__(self, workers=None, max_queue=None, max_per_client=2, timeout=120.0, max_body=8 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = self.workers * 2 if max_queue is None else max_queue
+        self.max_per_client = max_per_client
+        self.timeout = timeout
+        self.max_body = max_body
+        self.__context = multiprocessing.get_context("spawn")
+        self.__executor = ThreadPoolExecutor(self.workers)
+        self.__pool = []
+        self.__idle = None
+        self.__queued = 0
+        self.__clients = {}  # 客户端地址 -> 进行中的请求数
+
+    async def start(self):
+        """Starts the workers and waits until each has preloaded its fonts."""
+        self.__idle = asyncio.Queue()
+        self.__pool = [_WarmWorker(self.__context, self.__executor) for _ in range(self.workers)]
+        for worker in self.__pool:
+            worker.start()
+        for worker in self.__pool:
+            await worker.recv()  # ("ready",)
+            self.__idle.put_nowait(worker)
+
+    def close(self):
+        for worker in self.__pool:
+            worker.stop()
+        self.__executor.shutdown(wait=False)
+
+    async def handle(self, reader, writer):
+        client = (writer.get_extra_info("peername") or ("local",))[0]
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(self._read_request(reader), 30)
+            except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                await self._respond(writer, 400, {"error": "malformed request"})
+                return
+            if path == "/health":
+                await self._respond(writer, 200, {"workers": self.workers, "idle": self.__idle.qsize(),
+                                                  "queued": self.__queued})
+            elif path != "/render":
+                await self._respond(writer, 404, {"error": f"no such endpoint: {path}"})
+            elif method != "POST":
+                await self._respond(writer, 405, {"error": "use POST"})
+            elif body is None:
+                await self._respond(writer, 413, {"error": f"body larger than {self.max_body} bytes"})
+            else:
+                await self._render(client, body, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        method, path, _ = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > self.max_body:
+            return method, path.split("?")[0], headers, None
+        return method, path.split("?")[0], headers, await reader.readexactly(length)
+
+    @staticmethod
+    async def _respond(writer, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    @staticmethod
+    def _parse_job(body):
+        # 请求体为 JSON; config 可以是 JSON 对象或 TOML 字符串 (与 GUI 保存的配置文件相同)
+        request = json.loads(body)
+        text = request["text"]
+        config = request.get("config") or {}
+        if isinstance(config, str):
+            config = tomllib.loads(config)
+        if not isinstance(text, str) or not isinstance(config, dict):
+            raise ValueError("text must be a string and config an object or TOML string")
+        image_format = request.get("format", "png")
+        compress_level = int(request.get("compress_level", 6))
+        engine = request.get("engine", "handright")
+        if engine not in ("handright", "glyph", "numpy"):
+            raise ValueError(f"unknown engine: {engine}")
+        from writers import PageFormat
+        PageFormat(image_format, compress_level)  # 校验格式参数
+        return (text, config, image_format, compress_level, engine), request.get("timeout")
+
+    async def _render(self, client, body, writer):
+        try:
+            job, timeout = self._parse_job(body)
+            timeout = self.timeout if timeout is None else min(float(timeout), self.timeout)
+        except (ValueError, KeyError, TypeError, tomllib.TOMLDecodeError) as e:
+            await self._respond(writer, 400, {"error": str(e)})
+            return
+        if self.__clients.get(client, 0) >= self.max_per_client:
+            await self._respond(writer, 429, {"error": f"at most {self.max_per_client} concurrent requests per client"})
+            return
+        if self.__idle.empty() and self.__queued >= self.max_queue:
+            await self._respond(writer, 503, {"error": "all workers busy"})
+            return
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        self.__clients[client] = self.__clients.get(client, 0) + 1
+        self.__queued += 1
+        worker = None
+        try:
+            try:
+                worker = await asyncio.wait_for(self.__idle.get(), timeout)
+            except asyncio.TimeoutError:
+                await self._respond(writer, 503, {"error": "timed out waiting for a worker"})
+                return
+            finally:
+                self.__queued -= 1
+            await self._revive(worker)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                         b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+            await self._stream(worker, job, deadline, writer)
+        finally:
+            self.__clients[client] -= 1
+            if not self.__clients[client]:
+                del self.__clients[client]
+            if worker is not None:
+                # 工作进程意外退出时先重启, 不把失效的进程放回空闲队列
+                await self._revive(worker)
+                self.__idle.put_nowait(worker)
+
+    async def _stream(self, worker, job, deadline, writer):
+        loop = asyncio.get_running_loop()
+        worker.send(job)
+        try:
+            while True:
+                message = await worker.recv(max(deadline - loop.time(), 0))
+                if message[0] == "page":
+                    _, num, data = message
+                    line = {"page": num, "format": job[2], "data": base64.b64encode(data).decode("ascii")}
+                elif message[0] == "done":
+                    line = {"done": True, "pages": message[1], "seconds": round(message[2], 3)}
+                else:
+                    line = {"error": message[1]}
+                await self._write_chunk(writer, line)
+                if message[0] != "page":
+                    await self._write_chunk(writer, None)
+                    return
+        except asyncio.TimeoutError:
+            logger.warning("render timed out, cancelling")
+            await self._cancel(worker)
+            await self._write_chunk(writer, {"error": "timeout"})
+            await self._write_chunk(writer, None)
+        except (ConnectionError, EOFError, OSError) as e:
+            # 客户端断开或工作进程退出
+            logger.warning("render aborted: %s", e)
+            await self._cancel(worker)
+
+    @staticmethod
+    async def _write_chunk(writer, line):
+        if line is None:
+            writer.write(b"0\r\n\r\n")
+        else:
+            data = json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n"
+            writer.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _revive(worker):
+        if not worker.process.is_alive():
+            logger.warning("worker process exited with code %s, restarting it", worker.process.exitcode)
+            await worker.restart()
+
+    @staticmethod
+    async def _cancel(worker):
+        # 请工作进程在当前页完成后停止, 丢弃其余消息; 宽限期内未停止 (如大倍率的单页) 则重启
+        try:
+            worker.send("cancel")
+            while True:
+                message = await worker.recv(_CANCEL_GRACE)
+                if message[0] in ("done", "error", "cancelled"):
+                    return
+        except (asyncio.TimeoutError, EOFError, OSError):
+            await worker.restart()
+
+
+async def serve(host="127.0.0.1", port=8765, **options):
+    service = RenderService(**options)
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving on http://{host}:{port} with {service.workers} warm worker(s)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve handwriting rendering over HTTP with warm worker processes.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="warm worker processes, i.e. concurrent renders (default: all CPU cores)")
+    parser.add_argument("--max-queue", type=int, default=None,
+                        help="requests allowed to wait for a worker before answering 503 (default: 2 x workers)")
+    parser.add_argument("--max-per-client", type=int, default=2,
+                        help="concurrent requests per client address before answering 429 (default: 2)")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="maximum seconds per request; requests may ask for less (default: 120)")
+    parser.add_argument("--max-body", type=int, default=8, help="maximum request body in MiB (default: 8)")
+    parser.add_argument("--log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(serve(args.host, args.port, workers=args.workers, max_queue=args.max_queue,
+                          max_per_client=args.max_per_client, timeout=args.timeout, max_body=args.max_body << 20))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory hand-off of rendered pages from render worker processes.
+
+Returning a page from a pool worker pickles it, pipes it to the parent and unpickles it there, which
+for large rates costs more than rendering it. Instead, the parent owns a fixed set of page-sized
+multiprocessing.shared_memory blocks; each page is dispatched together with a free block, the
+worker writes its coverage mask into that block and only sends back the block's name, and the
+parent reads the mask in place before recycling the block for a later page. Pages are only
+dispatched while a block is free, so memory stays flat however long the batch is.
+"""
+import queue
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+# 工作进程中已打开的共享内存块, 键为块名; 同一批次内反复使用, 不必每页重新映射
+_attached = {}
+
+
+def write_page(name, mask):
+    """Copies a page mask into the shared memory block name (called in a worker process)."""
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = shared_memory.SharedMemory(name=name)
+    data = mask.tobytes()
+    block.buf[:len(data)] = data
+
+
+class SharedPagePool(object):
+    """
+    A fixed set of shared memory blocks, each large enough for one page mask.
+
+    Args:
+        nbytes: Size of one block, e.g. width * height for an "L" page.
+        count: Number of blocks, i.e. how many pages may be rendered ahead of the consumer.
+    """
+
+    def __init__(self, nbytes, count):
+        self.nbytes = nbytes
+        self.__blocks = {}
+        self.__free = queue.Queue()
+        try:
+            for _ in range(count):
+                block = shared_memory.SharedMemory(create=True, size=nbytes)
+                self.__blocks[block.name] = block
+                self.__free.put(block.name)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def acquire(self, stop=None):
+        """
+        Takes a free block, waiting until the consumer releases one.
+
+        Returns:
+            The block name, or None once the threading.Event stop is set.
+        """
+        while stop is None or not stop.is_set():
+            try:
+                return self.__free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def read(self, name, size, convert):
+        """Returns convert(mask) for the "L" page mask of the given size in block name, then frees the block."""
+        # frombuffer 直接映射共享内存, 不复制; convert 须产出新图片 (例如 Colorizer)
+        mask = Image.frombuffer("L", size, self.__blocks[name].buf, "raw", "L", 0, 1)
+        try:
+            return convert(mask)
+        finally:
+            mask.close()  # 释放对共享内存的引用, 否则关闭时无法解除映射
+            self.__free.put(name)
+
+    def close(self):
+        """Unmaps and removes every block; workers writing into them must have stopped."""
+        for block in self.__blocks.values():
+            block.close()
+            block.unlink()
+        self.__blocks.clear()
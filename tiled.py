@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded page rendering for high rates (x32/x64).
+
+handright draws every character of a page onto a full-size draft (mode "1", which Pillow stores
+at one byte per pixel), then copies the full-size background and perturbs every stroke of the
+page at once, which needs several GB per page at x64. The tiled renderer never allocates a
+full-page raster. It works from the glyph positions of layout.layout_pages(): glyphs whose boxes
+touch are grouped into clusters, and each cluster is drawn on its own small bitmap, exactly as
+it would appear on the draft. Output rows are produced in chunks of a fixed byte size; only the
+clusters whose perturbed strokes can land in a chunk are drawn and perturbed for it, and the
+finished rows are streamed straight into a PNG file. Peak memory is one output chunk plus one
+cluster of glyphs, independent of the page size.
+
+Strokes are connected components of ink pixels and never extend beyond a cluster. handright
+draws the offsets and rotation of the strokes in the order it discovers them, by their first
+ink pixel in row-major order; a first pass over the clusters finds the strokes of the page and
+draws their perturbations in that order, so the output is pixel-identical to the regular
+renderer.
+"""
+import math
+import random
+from array import array
+from pathlib import Path
+
+from handright import Template
+from handright._util import gauss
+from PIL import Image, ImageDraw
+
+from layout import _FontMetrics
+from writers import PngStreamWriter
+
+
+class SizedTemplate(Template):
+    """A handright Template reporting the full page size while carrying only a 1x1 background."""
+    __slots__ = ("_size",)
+
+    def __init__(self, size, **kwargs):
+        self._size = size
+        super(SizedTemplate, self).__init__(**kwargs)
+
+    def get_size(self):
+        return self._size
+
+
+def iter_clusters(glyphs, metrics, size):
+    """
+    Groups glyphs whose drawn pixels may touch, so that every stroke lies within one group.
+
+    Args:
+        glyphs: (char, (x, y), font_size) of a layout.PageLayout.
+        metrics: layout._FontMetrics providing the font of each glyph.
+        size: (width, height) of the page; pixels outside it are clipped like on the draft.
+
+    Yields:
+        (box, [(char, xy, font), ...]) where box = (left, upper, right, lower) on the page.
+    """
+    width, height = size
+    boxes = []
+    for char, (x, y), font_size in glyphs:
+        if font_size == 0:
+            continue
+        font = metrics.variant(font_size, metrics.fallback.get(char))
+        left, top, right, bottom = font.getbbox(char, mode="1")
+        # 外扩 1 像素: 4 邻域相邻的两个像素必然落在彼此外扩后的框内
+        box = (max(x + left - 1, 0), max(y + top - 1, 0), min(x + right + 1, width), min(y + bottom + 1, height))
+        if right > left and bottom > top and box[0] < box[2] and box[1] < box[3]:
+            boxes.append((box, (char, (x, y), font)))
+
+    # 按网格分桶, 只比较落在同一格中的框, 再用并查集合并相交的框
+    cell = max(max(box[2] - box[0], box[3] - box[1]) for box, _ in boxes) if boxes else 1
+    parent = list(range(len(boxes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = {}
+    for i, (box, _) in enumerate(boxes):
+        for cx in range(box[0] // cell, (box[2] - 1) // cell + 1):
+            for cy in range(box[1] // cell, (box[3] - 1) // cell + 1):
+                for j in buckets.setdefault((cx, cy), []):
+                    other = boxes[j][0]
+                    if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                        parent[find(i)] = find(j)
+                buckets[(cx, cy)].append(i)
+
+    clusters = {}
+    for i, (box, glyph) in enumerate(boxes):
+        root = find(i)
+        if root in clusters:
+            old, members = clusters[root]
+            clusters[root] = ((min(old[0], box[0]), min(old[1], box[1]), max(old[2], box[2]), max(old[3], box[3])),
+                              members)
+            members.append(glyph)
+        else:
+            clusters[root] = (box, [glyph])
+    yield from clusters.values()
+
+
+def _iter_strokes(box, members):
+    """
+    Draws a cluster of glyphs on its own small draft and splits it into strokes (4-connected
+    components of ink pixels) in the order handright discovers them on the full-page draft.
+
+    Yields:
+        (pixels, center, bounds): pixels is an array of indices into the cluster's box, row by row;
+        center and bounds = (min_x, min_y, max_x, max_y) of the stroke are in page coordinates.
+    """
+    left, upper, right, lower = box
+    width = right - left
+    draft = Image.new("1", (width, lower - upper), 0)
+    draw = ImageDraw.Draw(draft)
+    for char, (x, y), font in members:
+        draw.text((x - left, y - upper), char, fill=1, font=font)
+    # 每像素 1 字节的墨迹表, 访问过的像素清零; 用 find 在 C 层跳过空白, 依次找到每个笔画最靠上、最靠左的像素
+    ink = bytearray(draft.convert("L").tobytes())
+    size = len(ink)
+    start = ink.find(255)
+    while start != -1:
+        ink[start] = 0
+        pixels = array("I", (start,))
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            x = i % width
+            for j in (i - 1 if x > 0 else -1, i + 1 if x < width - 1 else -1, i - width, i + width):
+                if 0 <= j < size and ink[j]:
+                    ink[j] = 0
+                    pixels.append(j)
+                    stack.append(j)
+        min_x = min(i % width for i in pixels) + left
+        max_x = max(i % width for i in pixels) + left
+        min_y = start // width + upper
+        max_y = max(pixels) // width + upper
+        yield pixels, ((min_x + max_x) / 2, (min_y + max_y) / 2), (min_x, min_y, max_x, max_y)
+        start = ink.find(255, start + 1)
+
+
+class TiledPageRenderer(object):
+    """
+    Picklable callable that renders one layout.PageLayout chunk by chunk into a PNG file.
+
+    Args:
+        template: The template used for layout, usually a SizedTemplate.
+        hashed_seed: hash() of the seed passed to handwrite(), computed in the parent process.
+        output_dir: Folder receiving <page>.png.
+        colorizer: writers.Colorizer turning the ink mask of each flushed block of rows into page colors.
+        fallback: Optional {char: font} for characters the template's font lacks, as passed to
+            layout.layout_pages().
+        chunk_bytes: Size of the ink mask of one chunk of output rows.
+        flush_bytes: Size of a block of rows colorized and encoded at once.
+        compress_level: PNG zlib compression level.
+    """
+
+    def __init__(self, template, hashed_seed, output_dir, colorizer, fallback=None, chunk_bytes=16 << 20,
+                 flush_bytes=4 << 20, compress_level=6):
+        self.template = template
+        self.size = template.get_size()
+        self.colorizer = colorizer
+        self.fallback = fallback or {}
+        self.perturb_sigmas = (template.get_perturb_x_sigma(),
+                               template.get_perturb_y_sigma(),
+                               template.get_perturb_theta_sigma())
+        self.hashed_seed = hashed_seed
+        self.output_dir = Path(output_dir)
+        self.chunk_bytes = chunk_bytes
+        self.flush_bytes = flush_bytes
+        self.compress_level = compress_level
+
+    def __call__(self, page):
+        rand = random.Random()
+        if self.hashed_seed is None:
+            rand.seed()
+        else:
+            rand.seed(a=self.hashed_seed + page.num)
+        save_path = self.output_dir.joinpath(f"{page.num}.png")
+        clusters = list(iter_clusters(page.glyphs, _FontMetrics(self.template.get_font(), self.fallback), self.size))
+        perturbs, reach = self._perturbations(clusters, rand)
+        with PngStreamWriter(save_path, self.size, self.colorizer.mode, self.compress_level) as writer:
+            self._render(clusters, perturbs, reach, writer)
+        return page.num, save_path
+
+    def _perturbations(self, clusters, rand):
+        """
+        Draws (dx, dy, theta) for every stroke in handright's discovery order.
+
+        Returns:
+            (perturbs, reach): perturbs[i] lists the perturbation of each stroke of cluster i, and
+            reach[i] is the (top, bottom) row range its perturbed strokes can land in.
+        """
+        sigma_x, sigma_y, sigma_theta = self.perturb_sigmas
+        strokes = []
+        for index, (box, members) in enumerate(clusters):
+            width = box[2] - box[0]
+            for local, (pixels, center, bounds) in enumerate(_iter_strokes(box, members)):
+                # 笔画的第一个像素即 handright 逐行扫描整页草稿时发现它的位置
+                first_y, first_x = divmod(pixels[0], width)
+                strokes.append((first_y + box[1], first_x + box[0], index, local, center, bounds))
+        strokes.sort(key=lambda s: (s[0], s[1]))
+        perturbs = [[] for _ in clusters]
+        reach = [None] * len(clusters)
+        for _, _, index, local, center, (min_x, min_y, max_x, max_y) in strokes:
+            dx = gauss(rand, 0, sigma_x)
+            dy = gauss(rand, 0, sigma_y)
+            theta = gauss(rand, 0, sigma_theta)
+            perturbs[index].append((local, dx, dy, theta))
+            # 旋转后的像素不会离开以中心为圆心、外接框半对角线为半径的圆
+            radius = math.hypot((max_x - min_x) / 2, (max_y - min_y) / 2)
+            top = math.floor(center[1] + dy - radius) - 1
+            bottom = math.ceil(center[1] + dy + radius) + 2
+            old = reach[index]
+            reach[index] = (top, bottom) if old is None else (min(old[0], top), max(old[1], bottom))
+        for stroke_perturbs in perturbs:
+            stroke_perturbs.sort()
+        return perturbs, reach
+
+    def _render(self, clusters, perturbs, reach, writer):
+        width, height = self.size
+        chunk_rows = max(1, self.chunk_bytes // width)
+        for top in range(0, height, chunk_rows):
+            bottom = min(top + chunk_rows, height)
+            mask = bytearray(width * (bottom - top))  # 本块输出行的墨迹掩码, 每像素 1 字节
+            for index, (box, members) in enumerate(clusters):
+                if reach[index] is None or reach[index][1] <= top or reach[index][0] >= bottom:
+                    continue
+                # 跨越多个输出块的簇在每个块中重新绘制, 换取与页面大小无关的内存占用
+                left, upper, right, _ = box
+                box_width = right - left
+                strokes = _iter_strokes(box, members)
+                for (pixels, (cx, cy), _), (_, dx, dy, theta) in zip(strokes, perturbs[index]):
+                    # 与 handright._core._rotate 相同的运算顺序, 结果逐位一致
+                    cos, sin = math.cos(theta), math.sin(theta)
+                    for i in pixels:
+                        y, x = divmod(i, box_width)
+                        x += left
+                        y += upper
+                        if theta == 0:
+                            new_x, new_y = x, y
+                        else:
+                            new_x = (x - cx) * cos + (y - cy) * sin + cx
+                            new_y = (y - cy) * cos - (x - cx) * sin + cy
+                        new_x = round(new_x + dx)
+                        new_y = round(new_y + dy)
+                        if 0 <= new_x < width and top <= new_y < bottom:
+                            mask[(new_y - top) * width + new_x] = 255
+            self._flush(writer, mask, bottom - top)
+
+    def _flush(self, writer, mask, rows):
+        width = self.size[0]
+        flush_rows = max(1, self.flush_bytes // (width * len(self.colorizer.mode)))
+        for start in range(0, rows, flush_rows):
+            n = min(flush_rows, rows - start)
+            # 延迟着色: 仅在编码前将掩码转换为目标颜色
+            block = Image.frombuffer("L", (width, n), memoryview(mask)[start * width:(start + n) * width],
+                                     "raw", "L", 0, 1)
+            writer.write_image(self.colorizer(block))
+            block.close()
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-import os
-import fnmatch
+import threading
+import zlib
+from collections import OrderedDict
+
+from fonts import default_registry
 
 
 class BasicTools(object):
@@ -32,11 +35,74 @@ class BasicTools(object):
 
     @staticmethod
     def get_ttf_file_path() -> (list, list):
-        ttf_library_path = "ttf_library"
-        ttf_files = []
-        ttf_files_path = []
-        for file in os.listdir(ttf_library_path):
-            if fnmatch.fnmatch(file, '*.ttf'):
-                ttf_files.append(file[:-4])
-                ttf_files_path.append(os.path.join(ttf_library_path, file))
-        return ttf_files, ttf_files_path
+        # 由字体注册表提供, 不再每次扫描目录; 新代码请直接使用 fonts.default_registry()
+        registry = default_registry()
+        return registry.names, registry.paths
+
+
+class StableSeed(str):
+    """
+    A str seed whose hash() does not depend on PYTHONHASHSEED.
+
+    handright seeds layout with random.Random(seed), which is stable for str, but seeds each page's
+    stroke perturbation with hash(seed), which differs between interpreter runs for plain strings.
+    """
+
+    def __hash__(self):
+        return zlib.crc32(self.encode("utf-8"))
+
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache bounded by item count and/or total size.
+
+    Args:
+        max_items: Maximum number of entries kept, or None for no limit.
+        max_bytes: Maximum total size of the entries as reported by sizeof, or None for no limit.
+        sizeof: Callable returning the size in bytes of a cached value.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.__sizeof = sizeof or (lambda value: 0)
+        self.__entries = OrderedDict()  # key -> (value, size)
+        self.__total_bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.__sizeof(value)
+        with self.__lock:
+            if key in self.__entries:
+                self.__total_bytes -= self.__entries.pop(key)[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return  # 单个条目超过上限时不缓存
+            self.__entries[key] = (value, size)
+            self.__total_bytes += size
+            while ((self.max_items is not None and len(self.__entries) > self.max_items)
+                   or (self.max_bytes is not None and self.__total_bytes > self.max_bytes)):
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__total_bytes -= evicted_size
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__total_bytes = 0
+
+    @property
+    def total_bytes(self):
+        return self.__total_bytes
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Page writers: file formats, a background encoder stage and a streaming PNG writer.
+"""
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG 颜色类型: 灰度, 真彩色, 灰度 + alpha, 真彩色 + alpha
+_PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+
+
+class PageFormat(object):
+    """
+    File format of exported pages.
+
+    Args:
+        image_format: "png", "tiff" (uncompressed, the fastest to write) or "webp" (lossless).
+        compress_level: PNG zlib level 0-9; for WebP the encoder method, capped at 6.
+    """
+    __slots__ = ("image_format", "compress_level")
+    SUFFIXES = {"png": ".png", "tiff": ".tiff", "webp": ".webp"}
+
+    def __init__(self, image_format="png", compress_level=6):
+        if image_format not in self.SUFFIXES:
+            raise ValueError(f"unknown image format: {image_format}")
+        if not 0 <= compress_level <= 9:
+            raise ValueError("compress_level must be between 0 and 9")
+        self.image_format = image_format
+        self.compress_level = compress_level
+
+    @property
+    def suffix(self):
+        return self.SUFFIXES[self.image_format]
+
+    def page_path(self, output_dir, num):
+        return output_dir.joinpath(f"{num}{self.suffix}")
+
+    def save(self, im, path):
+        if self.image_format == "png":
+            im.save(path, "PNG", compress_level=self.compress_level)
+        elif self.image_format == "tiff":
+            im.save(path, "TIFF", compression=None)
+        else:
+            im.save(path, "WEBP", lossless=True, method=min(self.compress_level, 6))
+
+
+class Colorizer(object):
+    """
+    Colorizes an 8-bit ink coverage mask ("L", 255 where there is ink) into a page image.
+
+    Pages are rendered as coverage masks, a quarter of the size of RGBA pages, and only turned
+    into the export colors right before encoding. The result equals pasting fill through the
+    mask onto a page filled with background, including partial coverage and transparent
+    backgrounds, but is computed as one lookup table per channel.
+
+    Args:
+        background: Page color, e.g. (255, 255, 255, 255) or (0, 0, 0, 0) for transparent output.
+        fill: Ink color.
+        mode: PIL mode of the colorized page.
+    """
+    __slots__ = ("background", "fill", "mode", "luts")
+
+    def __init__(self, background, fill, mode="RGBA"):
+        self.background = tuple(background)
+        self.fill = tuple(fill)
+        self.mode = mode
+        # 对 0-255 的渐变掩码执行一次 paste, 得到每个通道从覆盖度到颜色的查找表
+        ramp = Image.frombytes("L", (256, 1), bytes(range(256)))
+        page = Image.new(mode, (256, 1), self.background)
+        page.paste(self.fill, (0, 0), ramp)
+        self.luts = [list(band.getdata()) for band in page.split()]
+
+    def __call__(self, mask):
+        bands = {}
+        for lut in self.luts:
+            key = tuple(lut)
+            if key not in bands:  # 例如黑色墨迹的 R、G、B 通道相同, 只计算一次
+                bands[key] = mask.point(lut)
+        return Image.merge(self.mode, [bands[tuple(lut)] for lut in self.luts])
+
+
+class Pyramid(object):
+    """
+    Derives lower-resolution copies of a page mask rendered at the highest rate.
+
+    Every level is box-filtered from the same strokes, so all resolutions carry exactly the same
+    handwriting, and its size equals a page rendered at that rate. Each level is reduced from the
+    smallest already computed level whose rate is a multiple of its own (x8 -> x4 -> x2), so
+    most levels are derived from an image a quarter of the size of the full page.
+
+    Args:
+        rates: Integer rates to export; the mask passed in is rendered at the highest of them.
+        copy_top: Copy the mask for the top level instead of keeping it, for masks that are views of a
+            buffer reused after the call (shared_pages.SharedPagePool.read).
+    """
+    __slots__ = ("rates", "copy_top")
+
+    def __init__(self, rates, copy_top=False):
+        self.rates = sorted(set(rates), reverse=True)
+        if not self.rates or self.rates[-1] < 1:
+            raise ValueError("rates must be positive integers")
+        self.copy_top = copy_top
+
+    def __call__(self, mask):
+        """Returns {rate: "L" mask}; the top level is mask itself unless copy_top is set."""
+        top = self.rates[0]
+        # 掩码不会被修改, 直接作为最高倍率; x32/x64 下整页复制需要数百 MB
+        levels = {top: mask.copy() if self.copy_top else mask}
+        for rate in self.rates[1:]:
+            source = min((r for r in levels if r % rate == 0), default=None)
+            if source is None:
+                # 倍率不成整数比时 (如 x3 与 x8) 直接从最高倍率按面积平均缩放
+                levels[rate] = mask.resize((mask.width * rate // top, mask.height * rate // top), Image.BOX)
+            else:
+                levels[rate] = levels[source].reduce(source // rate)
+        return levels
+
+
+def write_pages(pages, page_format, threads=2, max_pending=2, stats=None, colorize=None):
+    """
+    Encodes and writes pages on background threads while the next page is being rendered.
+
+    Pillow releases the GIL while compressing, so encoding overlaps with rendering in Python.
+    pages is consumed lazily; once max_pending pages are queued, the next page is only rendered
+    after the oldest one is written, so at most max_pending + 1 pages are held in memory.
+
+    Args:
+        pages: Iterable of (num, image, path).
+        page_format: PageFormat used to save the images.
+        threads: Number of encoder threads.
+        max_pending: Maximum number of pages waiting to be written.
+        stats: Optional profiling.RenderStats recording the "encode" time of every page.
+        colorize: Optional Colorizer applied to every page on the encoder thread, for pages
+            rendered as coverage masks.
+
+    Yields:
+        (num, path) in input order, as soon as each file is complete.
+    """
+    with ThreadPoolExecutor(threads, thread_name_prefix="page-writer") as executor:
+        pending = deque()
+        for num, im, path in pages:
+            if stats is None:
+                future = executor.submit(_save_page, page_format, colorize, im, path)
+            else:
+                future = executor.submit(stats.call, "encode", num, _save_page, page_format, colorize, im, path)
+            pending.append((num, path, future))
+            del im
+            while pending and (pending[0][2].done() or len(pending) > max_pending):
+                num, path, future = pending.popleft()
+                future.result()
+                yield num, path
+        while pending:
+            num, path, future = pending.popleft()
+            future.result()
+            yield num, path
+
+
+def _save_page(page_format, colorize, im, path):
+    page_format.save(im if colorize is None else colorize(im), path)
+
+
+class PngStreamWriter(object):
+    """
+    Writes a PNG file row by row, so only the rows passed to write_rows are ever held in memory.
+
+    Args:
+        path: Output file path.
+        size: (width, height) of the whole image.
+        mode: PIL mode of the rows, one of "L", "RGB", "LA" and "RGBA".
+        compress_level: zlib compression level, 0-9.
+    """
+
+    def __init__(self, path, size, mode="RGBA", compress_level=6):
+        self.width, self.height = size
+        self.mode = mode
+        self.__stride = self.width * len(mode)
+        self.__rows_written = 0
+        self.__compressor = zlib.compressobj(compress_level)
+        self.__file = open(path, "wb")
+        self.__file.write(_PNG_SIGNATURE)
+        self.__write_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8,
+                                                _PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+    def __write_chunk(self, chunk_type, data):
+        self.__file.write(struct.pack(">I", len(data)))
+        self.__file.write(chunk_type)
+        self.__file.write(data)
+        self.__file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_rows(self, data):
+        """Appends complete rows of raw pixel data (as returned by Image.tobytes())."""
+        rows = len(data) // self.__stride
+        stride = self.__stride
+        # 每行前加过滤类型字节 0 (None)
+        filtered = b"".join(b"\x00" + data[i * stride:(i + 1) * stride] for i in range(rows))
+        compressed = self.__compressor.compress(filtered)
+        if compressed:
+            self.__write_chunk(b"IDAT", compressed)
+        self.__rows_written += rows
+
+    def write_image(self, im):
+        """Appends the rows of a PIL image whose width and mode match the writer."""
+        self.write_rows(im.tobytes())
+
+    def close(self):
+        if self.__file.closed:
+            return
+        if self.__rows_written != self.height:
+            self.__file.close()
+            raise ValueError(f"expected {self.height} rows, got {self.__rows_written}")
+        self.__write_chunk(b"IDAT", self.__compressor.flush())
+        self.__write_chunk(b"IEND", b"")
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.close()
+
+
+class PdfPage(object):
+    """A page image compressed for PDF embedding by encode_pdf_page; small enough to pass between processes."""
+    __slots__ = ("width", "height", "color_space", "data", "alpha")
+
+    def __init__(self, width, height, color_space, data, alpha=None):
+        self.width = width
+        self.height = height
+        self.color_space = color_space  # "/DeviceRGB" 或 "/DeviceGray"
+        self.data = data  # Flate 压缩的颜色数据
+        self.alpha = alpha  # Flate 压缩的 alpha 通道 (SMask), 不透明图片为 None
+
+
+def encode_pdf_page(im, compress_level=6, band_rows=256):
+    """
+    Compresses a page image into a PdfPage, converting band_rows rows at a time so that no
+    full-page copy is made. The alpha channel, if any, becomes a soft mask over the paper.
+    """
+    if im.mode not in ("L", "LA", "RGB", "RGBA"):
+        im = im.convert("RGBA")
+    color_mode = "L" if im.mode in ("L", "LA") else "RGB"
+    has_alpha = im.mode in ("LA", "RGBA")
+    color = zlib.compressobj(compress_level)
+    alpha = zlib.compressobj(compress_level)
+    color_chunks = []
+    alpha_chunks = []
+    for top in range(0, im.height, band_rows):
+        band = im.crop((0, top, im.width, min(top + band_rows, im.height)))
+        color_chunks.append(color.compress(band.convert(color_mode).tobytes()))
+        if has_alpha:
+            alpha_chunks.append(alpha.compress(band.getchannel("A").tobytes()))
+    color_chunks.append(color.flush())
+    if has_alpha:
+        alpha_chunks.append(alpha.flush())
+    return PdfPage(im.width, im.height, "/DeviceGray" if color_mode == "L" else "/DeviceRGB",
+                   b"".join(color_chunks), b"".join(alpha_chunks) if has_alpha else None)
+
+
+class PdfStreamWriter(object):
+    """
+    Writes a multi-page PDF one page at a time; pages are written as soon as they are added.
+
+    Args:
+        path: Output file path.
+        dpi: Resolution of the page images, which sets the physical page size.
+    """
+
+    def __init__(self, path, dpi):
+        self.dpi = dpi
+        self.__file = open(path, "wb")
+        self.__offsets = {}
+        self.__kids = []
+        self.__next_id = 3  # 1: Catalog, 2: Pages (在 close 时写出)
+        self.__file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.__write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    def __allocate(self):
+        object_id = self.__next_id
+        self.__next_id += 1
+        return object_id
+
+    def __write_object(self, object_id, body, stream=None):
+        self.__offsets[object_id] = self.__file.tell()
+        self.__file.write(b"%d 0 obj\n" % object_id)
+        self.__file.write(body)
+        if stream is not None:
+            self.__file.write(b"\nstream\n")
+            self.__file.write(stream)
+            self.__file.write(b"\nendstream")
+        self.__file.write(b"\nendobj\n")
+
+    def __write_image(self, page):
+        image_id = self.__allocate()
+        smask = b""
+        if page.alpha is not None:
+            smask_id = self.__allocate()
+            self.__write_object(smask_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                                          b"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode "
+                                          b"/Length %d >>" % (page.width, page.height, len(page.alpha)),
+                                page.alpha)
+            smask = b" /SMask %d 0 R" % smask_id
+        self.__write_object(image_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                                      b"/ColorSpace %s /BitsPerComponent 8 /Filter /FlateDecode /Length %d%s >>"
+                            % (page.width, page.height, page.color_space.encode("ascii"), len(page.data), smask),
+                            page.data)
+        return image_id
+
+    def add_page(self, page):
+        """Appends a PdfPage (or a PIL image, which is encoded first) as a new page."""
+        if not isinstance(page, PdfPage):
+            page = encode_pdf_page(page)
+        image_id = self.__write_image(page)
+        # 页面尺寸 (pt) = 像素 / dpi * 72
+        width = page.width * 72 / self.dpi
+        height = page.height * 72 / self.dpi
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (width, height)
+        content_id = self.__allocate()
+        self.__write_object(content_id, b"<< /Length %d >>" % len(content), content)
+        page_id = self.__allocate()
+        self.__write_object(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+                                     b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+                            % (width, height, image_id, content_id))
+        self.__kids.append(page_id)
+
+    def close(self):
+        if self.__file.closed:
+            return
+        kids = b" ".join(b"%d 0 R" % kid for kid in self.__kids)
+        self.__write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.__kids)))
+        xref_offset = self.__file.tell()
+        self.__file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.__next_id)
+        for object_id in range(1, self.__next_id):
+            self.__file.write(b"%010d 00000 n \n" % self.__offsets[object_id])
+        self.__file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                          % (self.__next_id, xref_offset))
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.close()